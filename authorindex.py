@@ -0,0 +1,237 @@
+"""
+authorindex.py
+
+Every post by a user or a bitcoin address, newest first, for profile
+pages, per-user feeds and moderators. Posts are rows of an SQLite
+database at AUTHOR_DB holding where each post is (subforum, thread,
+number) and when it was published, indexed by author and by address,
+so a page of someone's posts is one index range read however many
+threads there are. Post counts are kept alongside.
+
+new_thread and commit_replies add their posts as they write them. If
+that fails, e.g. on a database locked for too long, the posts are kept
+in the process and tried again with the next ones.
+
+To index everything already written:
+
+    python authorindex.py [static_dir]
+
+which empties the index and streams every post of the store back into
+it, committing every REBUILD_BATCH posts so the web nodes can go on
+adding theirs in between. Profiles show the posts indexed so far.
+"""
+import os
+import sys
+import sqlite3
+import threading
+
+import util
+import store
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS posts (
+    id INTEGER PRIMARY KEY,
+    author TEXT NOT NULL,
+    address TEXT NOT NULL,
+    subforum TEXT NOT NULL,
+    thread TEXT NOT NULL,
+    n INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    published TEXT NOT NULL,
+    UNIQUE (subforum, thread, n)
+);
+CREATE INDEX IF NOT EXISTS posts_by_author
+    ON posts (author, published DESC, id DESC);
+CREATE INDEX IF NOT EXISTS posts_by_address
+    ON posts (address, published DESC, id DESC);
+CREATE TABLE IF NOT EXISTS counts (
+    field TEXT NOT NULL,
+    value TEXT NOT NULL,
+    num_posts INTEGER NOT NULL,
+    last_published TEXT,
+    PRIMARY KEY (field, value)
+) WITHOUT ROWID;
+"""
+
+# What a profile can be looked up by
+FIELDS = ('author', 'address')
+
+# Posts indexed by rebuild() per transaction
+REBUILD_BATCH = 500
+# Posts kept to index again after a failure, the oldest dropped past it
+MAX_RETRY_POSTS = 10000
+
+
+class AuthorIndex(object):
+    """ Posts by author and by address in one SQLite file """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def db(self):
+        """ This thread's connection, opened on first use """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _add(self, db, subforum, thread_name, post):
+        author = post.get('author') or ''
+        address = post.get('bit_btcaddress') or ''
+        published = post.get('published') or ''
+        cursor = db.execute(
+            'INSERT OR IGNORE INTO posts (author, address, subforum, thread, '
+            'n, title, published) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (author, address, subforum, thread_name, post['n'],
+             post.get('title') or '', published))
+        if not cursor.rowcount:
+            # Already indexed
+            return
+
+        for field, value in zip(FIELDS, (author, address)):
+            db.execute('INSERT OR IGNORE INTO counts VALUES (?, ?, 0, NULL)',
+                       (field, value))
+            db.execute('UPDATE counts SET num_posts = num_posts + 1, '
+                       'last_published = max(coalesce(last_published, \'\'), ?) '
+                       'WHERE field = ? AND value = ?',
+                       (published, field, value))
+
+    def add_posts(self, subforum, thread_name, posts):
+        """ Index new posts of a thread, each with its number in post['n'] """
+        self.add_batches([(subforum, thread_name, posts)])
+
+    def add_batches(self, batches):
+        """ add_posts for each (subforum, thread, posts), in one transaction """
+        db = self.db()
+        with db:
+            for subforum, thread_name, posts in batches:
+                for post in posts:
+                    self._add(db, subforum, thread_name, post)
+
+    def posts(self, field, value, before=None, limit=20):
+        """
+        Posts by an author or address, newest first, from the one after
+        the post with id before on, up to limit of them, and the cursor
+        of the page after that (None on the last page)
+        """
+        if field not in FIELDS:
+            raise ValueError('Unknown field ' + repr(field))
+
+        db = self.db()
+        query = 'SELECT * FROM posts WHERE {} = ?'.format(field)
+        args = [value]
+        if before is not None:
+            query += (' AND (published, id) < '
+                      '(SELECT published, id FROM posts WHERE id = ?)')
+            args.append(before)
+        query += ' ORDER BY published DESC, id DESC LIMIT ?'
+        # One more to see whether there's a page after this
+        args.append(limit + 1)
+
+        rows = [dict(row) for row in db.execute(query, args)]
+        cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            cursor = rows[-1]['id']
+        return rows, cursor
+
+    def counts(self, field, value):
+        """ {'num_posts', 'last_published'} of an author or address """
+        row = self.db().execute(
+            'SELECT num_posts, last_published FROM counts '
+            'WHERE field = ? AND value = ?', (field, value)).fetchone()
+        if row is None:
+            return {'num_posts': 0, 'last_published': None}
+        return dict(row)
+
+
+_indexes = {}
+
+
+def get_index():
+    """ The index at AUTHOR_DB, or None if it's off """
+    from main import app
+
+    path = app.config.get('AUTHOR_DB')
+    if not path:
+        return None
+    if path not in _indexes:
+        _indexes[path] = AuthorIndex(path)
+    return _indexes[path]
+
+
+_failed = []
+_failed_lock = threading.Lock()
+
+
+def add_posts(subforum, thread_name, posts):
+    """
+    Index posts just written to a thread. The posts are safely stored
+    already, so a failure here is reported and the posts kept to try
+    again with the next ones, up to MAX_RETRY_POSTS of them; the rest
+    are left for a rebuild.
+    """
+    index = get_index()
+    if index is None:
+        return
+    with _failed_lock:
+        batches = _failed[:]
+        del _failed[:]
+    batches.append((subforum, thread_name, list(posts)))
+    try:
+        index.add_batches(batches)
+    except sqlite3.Error as e:
+        with _failed_lock:
+            _failed[:0] = batches
+            kept = sum(len(posts) for _, _, posts in _failed)
+            while kept > MAX_RETRY_POSTS:
+                kept -= len(_failed.pop(0)[2])
+        sys.stderr.write('Indexing authors of {}{} failed, {} posts to try '
+                         'again: {!r}\n'.format(subforum, thread_name, kept,
+                                                 e))
+
+
+def _index_subforum(index, db, current_subforum, added=0):
+    """ Index a subforum and below, and return the count of posts added """
+    threads = store.get_store()
+    subforum = os.path.normpath(current_subforum)[len('static'):] or '/'
+    for thread_name in threads.threads(subforum):
+        for post in threads.posts(thread_name, subforum):
+            index._add(db, subforum, thread_name, post)
+            added += 1
+            if not added % REBUILD_BATCH:
+                db.commit()
+        print 'Indexed ' + os.path.join(current_subforum, thread_name)
+
+    for name in util.find_subforums(current_subforum):
+        added = _index_subforum(index, db, os.path.join(current_subforum,
+                                                        name), added)
+    return added
+
+
+def rebuild(current_subforum='static'):
+    """ Index every post of the store from scratch """
+    from main import app
+
+    index = AuthorIndex(app.config.get('AUTHOR_DB') or 'authors.db')
+    db = index.db()
+    with db:
+        db.execute('DELETE FROM posts')
+        db.execute('DELETE FROM counts')
+    # Posts written meanwhile are either read here or added by their
+    # writer, and adding a post twice does nothing
+    with db:
+        _index_subforum(index, db, current_subforum)
+    return db.execute('SELECT COUNT(*) FROM posts').fetchone()[0]
+
+
+if __name__ == '__main__':
+    # python authorindex.py [static_dir]
+    print 'Indexed {} posts'.format(
+        rebuild(sys.argv[1] if len(sys.argv) > 1 else 'static'))
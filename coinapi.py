@@ -0,0 +1,289 @@
+"""
+coinapi.py
+
+The client for the cryptoapi service (COIN_API), for when signatures
+are checked there (SIG_VERIFIER = 'remote'). A stalled or dead service
+mustn't take the forum down with it, so
+
+- connections are kept alive in a pool of COIN_API_POOL_SIZE, which is
+  also how many calls may be waiting on the service at once; a call
+  beyond that fails at once instead of tying up one more web worker,
+- a call gives up at its deadline, retries included,
+- failed calls (no connection, timeouts, 5xx) are retried up to
+  COIN_API_RETRIES times, after a random wait of up to
+  COIN_API_BACKOFF * 2**attempt so retries from many workers spread out,
+- after COIN_API_BREAKER_FAILURES failed attempts in a row the circuit
+  opens: calls fail at once for COIN_API_BREAKER_RESET seconds, then a
+  single call is let through to see whether the service is back.
+
+Every cryptoapi call is a pure function of its arguments, so retrying
+one is safe. Latencies of calls and of each attempt are kept in
+histograms per path, see stats() and report().
+"""
+import time
+import socket
+import random
+import bisect
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import config
+
+POOL_SIZE = getattr(config, 'COIN_API_POOL_SIZE', 10)
+RETRIES = getattr(config, 'COIN_API_RETRIES', 2)
+BACKOFF = getattr(config, 'COIN_API_BACKOFF', 0.05)
+BREAKER_FAILURES = getattr(config, 'COIN_API_BREAKER_FAILURES', 5)
+BREAKER_RESET = getattr(config, 'COIN_API_BREAKER_RESET', 30)
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+           1, 2, 5, 10)
+
+
+class CoinApiError(Exception):
+    """ A call to cryptoapi that didn't get an answer """
+    pass
+
+
+class CircuitOpen(CoinApiError):
+    """ The service has been failing, calls aren't even tried for now """
+    pass
+
+
+class Histogram(object):
+    """ Counts of latencies by bucket, the last bucket counting the rest """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        """ Upper bound of the bucket the p-th percentile falls in """
+        if not self.count:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def as_dict(self):
+        return {'count': self.count,
+                'total': self.total,
+                'max': self.max,
+                'buckets': zip(self.buckets + (None,), self.counts)}
+
+
+class CircuitBreaker(object):
+    """
+    Closed while calls succeed. Open for reset seconds after failures
+    failed attempts in a row, and then half open: one trial call goes
+    through, and closes it again or opens it for another reset seconds.
+    """
+
+    def __init__(self, failures=BREAKER_FAILURES, reset=BREAKER_RESET):
+        self.failures = failures
+        self.reset = reset
+        self.failed = 0
+        self.opened_at = None
+        self.trial = False
+        self.opened = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """ Whether a call may go ahead now """
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.trial or time.time() - self.opened_at < self.reset:
+                return False
+            self.trial = True
+            return True
+
+    def succeeded(self):
+        with self._lock:
+            self.failed = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failed_call(self):
+        with self._lock:
+            self.failed += 1
+            if self.trial or (self.opened_at is None and
+                              self.failed >= self.failures):
+                self.opened_at = time.time()
+                self.opened += 1
+            self.trial = False
+
+    def state(self):
+        with self._lock:
+            if self.opened_at is None:
+                return 'closed'
+            return 'half open' if self.trial else 'open'
+
+
+class CoinApiClient(object):
+    """ Calls to the cryptoapi service at url """
+
+    def __init__(self, url, timeout=None, pool_size=POOL_SIZE,
+                 retries=RETRIES, backoff=BACKOFF, breaker=None):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.breaker = breaker or CircuitBreaker()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+        self._lock = threading.Lock()
+        self.calls = {}
+        self.attempts = {}
+        self.counts = {}
+
+    def _count(self, path, what):
+        with self._lock:
+            counts = self.counts.setdefault(path, {})
+            counts[what] = counts.get(what, 0) + 1
+
+    def _observe(self, histograms, path, seconds):
+        with self._lock:
+            histogram = histograms.get(path)
+            if histogram is None:
+                histogram = histograms[path] = Histogram()
+            histogram.observe(seconds)
+
+    def _attempt(self, path, data, timeout):
+        """ One request, its response or None if it failed """
+        start = time.time()
+        try:
+            resp = self.session.post(self.url + path, data, timeout=timeout)
+        except (requests.RequestException, socket.error):
+            # requests lets some read timeouts through as they are
+            resp = None
+        self._observe(self.attempts, path, time.time() - start)
+        if resp is not None and resp.status_code >= 500:
+            return None
+        return resp
+
+    def post(self, path, data, timeout=None):
+        """
+        The service's response to a POST of data to path, taking no
+        more than timeout seconds (the client's timeout by default) in
+        all. A 4xx response is an answer like any other. Raises
+        CoinApiError if there's no answer, CircuitOpen without trying.
+        """
+        timeout = timeout if timeout is not None else self.timeout
+        start = time.time()
+        deadline = start + timeout if timeout is not None else None
+
+        if not self._slots.acquire(False):
+            self._count(path, 'busy')
+            raise CoinApiError('{} calls to {} in flight already'.format(
+                self.pool_size, self.url))
+        try:
+            attempt = 0
+            while True:
+                if not self.breaker.allow():
+                    self._count(path, 'rejected')
+                    raise CircuitOpen('{} is failing, not calling it '
+                                      'for now'.format(self.url))
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                resp = self._attempt(path, data, remaining)
+                if resp is not None:
+                    self.breaker.succeeded()
+                    self._count(path, 'ok')
+                    return resp
+                self.breaker.failed_call()
+
+                attempt += 1
+                wait = random.uniform(0, self.backoff * 2 ** (attempt - 1))
+                if (attempt > self.retries or deadline is not None and
+                        time.time() + wait >= deadline):
+                    self._count(path, 'failed')
+                    raise CoinApiError('No answer from {}{} after {} '
+                                       'attempts'.format(self.url, path,
+                                                         attempt))
+                self._count(path, 'retries')
+                time.sleep(wait)
+        finally:
+            self._slots.release()
+            self._observe(self.calls, path, time.time() - start)
+
+    def stats(self):
+        """ {path: counts and call and attempt latency histograms} """
+        with self._lock:
+            paths = set(self.calls) | set(self.counts)
+            return dict((path, {
+                'counts': dict(self.counts.get(path, {})),
+                'calls': self.calls[path].as_dict()
+                if path in self.calls else None,
+                'attempts': self.attempts[path].as_dict()
+                if path in self.attempts else None}) for path in paths)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client():
+    """ The client for COIN_API, one per process """
+    from main import app
+
+    url = app.config['COIN_API']
+    with _clients_lock:
+        client = _clients.get(url)
+        if client is None:
+            client = _clients[url] = CoinApiClient(
+                url, app.config.get('SIG_VERIFY_TIMEOUT'))
+    return client
+
+
+def stats():
+    """ {url: client stats()} of this process """
+    with _clients_lock:
+        clients = _clients.items()
+    return dict((url, client.stats()) for url, client in clients)
+
+
+def report():
+    """ Lines summing up each client's calls, by path """
+    lines = []
+    with _clients_lock:
+        clients = sorted(_clients.items())
+    for url, client in clients:
+        lines.append('{} circuit {}, opened {} times'.format(
+            url, client.breaker.state(), client.breaker.opened))
+        with client._lock:
+            for path, histogram in sorted(client.calls.items()):
+                counts = client.counts.get(path, {})
+                lines.append(
+                    '  {} {} calls: {} ok, {} failed, {} retries, '
+                    '{} rejected, {} busy; p50 <= {}s, p99 <= {}s, '
+                    'max {:.3f}s'.format(
+                        path, histogram.count, counts.get('ok', 0),
+                        counts.get('failed', 0), counts.get('retries', 0),
+                        counts.get('rejected', 0), counts.get('busy', 0),
+                        histogram.percentile(50), histogram.percentile(99),
+                        histogram.max))
+    return lines
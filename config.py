@@ -14,5 +14,88 @@ MODE = 'http'
 SITE_ROOT = MODE + '://' + SERVER_NAME
 HOST = '0.0.0.0'
 COIN_API = 'http://localhost:5000'
+# How login and registration signatures are checked (sigverify.py):
+# 'local' in the web process, 'remote' by the cryptoapi service at
+# COIN_API, given up on after SIG_VERIFY_TIMEOUT seconds
+SIG_VERIFIER = 'local'
+SIG_VERIFY_TIMEOUT = 5
+# The cryptoapi client (coinapi.py): connections kept alive, and calls
+# in flight at once; retries of a failed call, waiting up to
+# COIN_API_BACKOFF * 2**attempt seconds first; the circuit opens after
+# COIN_API_BREAKER_FAILURES failed attempts in a row, for
+# COIN_API_BREAKER_RESET seconds
+COIN_API_POOL_SIZE = 10
+COIN_API_RETRIES = 2
+COIN_API_BACKOFF = 0.05
+COIN_API_BREAKER_FAILURES = 5
+COIN_API_BREAKER_RESET = 30
 # Not including the title post
 NUM_POSTS_PER_PAGE = 19
+# Threads listed per page of a subforum
+THREADS_PER_PAGE = 50
+# Send thread pages while they render, flushing every
+# STREAM_BUFFER_SIZE template chunks
+STREAM_THREAD_PAGES = False
+STREAM_BUFFER_SIZE = 8
+
+# How threads are stored:
+#   'rss' - each reply rewrites static/<thread>.rss
+#   'log' - replies are appended to static/<thread>.log, and the .rss
+#           feed is exported from it when stale (python postlog.py)
+#   'sqlite' - threads and posts live in the SQLITE_PATH database, the
+#           .rss feeds are exported from it when stale
+#   'segments' - each thread is a static/<thread>.segments directory of
+#           files of SEGMENT_SIZE posts; only the last one is written
+#           to, the others are sealed, gzipped and cached for good
+# Move existing threads over with python store.py migrate <from> <to>
+THREAD_STORAGE = 'rss'
+SQLITE_PATH = 'forum.db'
+SEGMENT_SIZE = 100
+
+# Write-behind replies (replyqueue.py): None writes a reply to its
+# thread before answering. 'redis' or 'journal' (REPLY_JOURNAL) queue it
+# durably and answer at once, and a flusher writes queued replies to
+# their threads every REPLY_FLUSH_INTERVAL seconds or sooner. The
+# flusher runs in the web processes, or set REPLY_FLUSHER_THREAD = False
+# and run python replyqueue.py. Replies to a thread that fail to go in
+# for REPLY_DEAD_AFTER seconds are set aside in a dead letter list.
+REPLY_QUEUE = None
+REPLY_JOURNAL = 'replies.journal'
+REPLY_FLUSHER_THREAD = True
+REPLY_FLUSH_INTERVAL = 0.5
+REPLY_DEAD_AFTER = 300
+
+# Parsed threads kept in memory per process, bounded by count and by
+# the total size of their files on disk
+THREAD_CACHE_ENTRIES = 256
+THREAD_CACHE_BYTES = 64 * 1024 * 1024
+
+# Rendered thread pages and listings kept for logged-out readers,
+# 0 turns the snapshot cache off
+PAGE_CACHE_ENTRIES = 1024
+
+# Full text search index of the posts (searchindex.py), None turns
+# search off. Fill it from existing threads with python searchindex.py
+SEARCH_DB = 'search.db'
+SEARCH_RESULTS_PER_PAGE = 20
+
+# Posts by author and by bitcoin address (authorindex.py), for the
+# /user/<name> and /address/<address> pages and feeds. None turns them
+# off. Fill it from existing threads with python authorindex.py
+AUTHOR_DB = 'authors.db'
+PROFILE_POSTS_PER_PAGE = 20
+
+# Named locks (locks.py) are files in LOCK_DIR. LOCK_TIMEOUT is how many
+# seconds to wait for one before failing, None waits as long as it takes
+LOCK_DIR = '.locks'
+LOCK_TIMEOUT = None
+
+# 'file' locks only cover this host. Set 'redis' when several web nodes
+# share the thread storage: locks become leases of LOCK_LEASE seconds in
+# the session Redis, with fencing tokens. 'memory' is the same inside
+# one process, for testing without a Redis server. With 'redis', the
+# storage keeps the last fencing token written under each lock in
+# FENCE_DIR, which must be on the storage the nodes share.
+LOCK_BACKEND = 'file'
+LOCK_LEASE = 30
+FENCE_DIR = '.fences'
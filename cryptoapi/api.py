@@ -1,6 +1,7 @@
 import flask
 import crypto
 import hashlib
+import json
 import string
 import binascii
 import generate_keypair
@@ -162,5 +163,51 @@ def check_signature():
         print traceback.format_exc()
         abort(400)
 
+
+# Most triples /check_sigs takes in one request
+MAX_BATCH = 1000
+
+
+@app.route("/check_sigs", methods=['POST'])
+def check_signatures():
+    """
+    Check many signatures at once. Takes a JSON array of [message,
+    signature, btc_addr] triples (or objects with those keys, btc_addr
+    optional) and returns an array of {"valid": true, "btc_addr": ...}
+    or {"valid": false, "error": ...}, one per triple, in order. A
+    malformed triple gets its error like a bad signature does.
+    """
+    triples = request.get_json(force=True, silent=True)
+    if not isinstance(triples, list):
+        abort(400)
+    if len(triples) > MAX_BATCH:
+        abort(413)
+    results = [None] * len(triples)
+    items = []
+    for i, triple in enumerate(triples):
+        try:
+            if isinstance(triple, dict):
+                message = triple['message']
+                signature = triple['signature']
+                btc_addr = triple.get('btc_addr')
+            else:
+                message, signature, btc_addr = triple
+            if not (isinstance(message, basestring) and
+                    isinstance(signature, basestring) and
+                    (btc_addr is None or isinstance(btc_addr, basestring))):
+                raise TypeError('Not strings')
+        except (KeyError, TypeError, ValueError):
+            results[i] = {'valid': False, 'error': 'Malformed triple'}
+            continue
+        items.append((i, (btc_addr, signature, message)))
+
+    checked = generate_keypair.verify_messages([item for _, item in items])
+    for (i, _), (addr, error) in zip(items, checked):
+        if error is None:
+            results[i] = {'valid': True, 'btc_addr': addr}
+        else:
+            results[i] = {'valid': False, 'error': error}
+    return flask.Response(json.dumps(results), mimetype='application/json')
+
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,80 @@
+"""
+Time a login's signature check with python-ecdsa's affine arithmetic
+and with curvemath, one signature at a time (verify_message, what
+/check_sig and the forum do) and in a batch (verify_messages, what
+/check_sigs does), checking both give the same answers.
+
+    python bench_verify.py [signatures]
+"""
+import sys
+import time
+import random
+
+import generate_keypair
+
+
+def make_signatures(count):
+    """ count (address, signature, message) triples, the last few bad """
+    rand = random.Random(count)
+    items = []
+    for i in range(count):
+        secret = rand.getrandbits(256) % (generate_keypair.curvemath.N - 1) + 1
+        address = generate_keypair.generate_btc_address(secret)[3]
+        message = 'site-auth-data::{}:'.format(rand.getrandbits(64))
+        items.append((address, generate_keypair.sign_message(secret, message),
+                      message))
+    # A wrong address and a tampered message
+    if count > 2:
+        items[-1] = (items[0][0], items[-1][1], items[-1][2])
+        items[-2] = (items[-2][0], items[-2][1], items[-2][2] + '!')
+    return items
+
+
+def check_all(items):
+    results = []
+    for address, signature, message in items:
+        try:
+            results.append(generate_keypair.EC_KEY.verify_message(
+                address, signature, message))
+        except Exception:
+            results.append(None)
+    return results
+
+
+def timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return result, time.time() - start
+
+
+def main(count):
+    items = make_signatures(count)
+
+    engine = generate_keypair.ENGINE
+    try:
+        generate_keypair.ENGINE = 'ecdsa'
+        affine, affine_time = timed(check_all, items)
+        generate_keypair.ENGINE = 'curvemath'
+        jacobian, jacobian_time = timed(check_all, items)
+    finally:
+        generate_keypair.ENGINE = engine
+    batch, batch_time = timed(generate_keypair.verify_messages, items)
+
+    if affine != jacobian or affine != [address for address, _ in batch]:
+        print 'Results differ!'
+        return 1
+
+    per_login = lambda seconds: seconds / count * 1000
+    print '{} signatures, {} bad'.format(
+        count, sum(1 for address in affine if address is None))
+    print 'python-ecdsa, one at a time: {:8.2f} ms per login'.format(
+        per_login(affine_time))
+    print 'curvemath, one at a time:    {:8.2f} ms per login, {:.1f}x'.format(
+        per_login(jacobian_time), affine_time / jacobian_time)
+    print 'curvemath, batched:          {:8.2f} ms per login, {:.1f}x'.format(
+        per_login(batch_time), affine_time / batch_time)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 50))
@@ -0,0 +1,312 @@
+"""
+secp256k1 arithmetic for recovering and verifying message signatures,
+in place of python-ecdsa's Point on the hot path.
+
+python-ecdsa adds points in affine coordinates, a modular inversion
+per addition, and multiplies by plain double-and-add. Here points are
+kept in Jacobian coordinates (x = X/Z^2, y = Y/Z^3), so additions and
+doublings are only multiplications and one inversion at the end gets
+back to x and y. Scalars are written in windowed NAF, which leaves a
+nonzero digit every w+1 bits on average, against precomputed odd
+multiples of the point: those of G once at import, those of any other
+point per multiplication. And a*G + b*Q, all a recovery or a
+verification needs, is done in one pass over both scalars sharing the
+doublings (Shamir/Straus).
+
+recover_many() recovers a batch of keys with three inversions in all,
+one for each step that needs them (the r's, the tables of the R's, the
+keys themselves), by Montgomery's trick across the batch.
+
+Points handed in and out are affine (x, y) tuples, None being the
+point at infinity.
+"""
+
+P = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEFFFFFC2FL
+N = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141L
+B = 7
+G = (0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798L,
+     0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8L)
+
+# wNAF window widths: G's table is built once so it can be wide,
+# other points' tables are built per multiplication
+G_WINDOW = 8
+WINDOW = 5
+
+INFINITY = (1, 1, 0)
+
+
+def inverse(a, m):
+    """ Inverse of a mod m, by the extended Euclidean algorithm """
+    a %= m
+    if not a:
+        raise ZeroDivisionError('0 has no inverse')
+    u, v = 1, 0
+    c, d = a, m
+    while c:
+        q, c, d = d // c, d % c, c
+        u, v = v - q * u, u
+    return v % m
+
+
+def batch_inverse(values, m):
+    """
+    Inverses of all values mod m with a single modular inversion
+    (Montgomery's trick): invert the product of them all, then peel the
+    inverse of each off with multiplications
+    """
+    prefix = []
+    product = 1
+    for value in values:
+        prefix.append(product)
+        product = product * value % m
+    inv = inverse(product, m) if values else 1
+    inverses = [0] * len(values)
+    for i in range(len(values) - 1, -1, -1):
+        inverses[i] = inv * prefix[i] % m
+        inv = inv * values[i] % m
+    return inverses
+
+
+def on_curve(point):
+    x, y = point
+    return 0 <= x < P and 0 <= y < P and (y * y - x * x * x - B) % P == 0
+
+
+def lift_x(x, odd):
+    """ The point with this x and a y of this parity """
+    if not 0 <= x < P:
+        raise ValueError('x out of range')
+    alpha = (x * x * x + B) % P
+    # P = 3 mod 4, so this is a square root if alpha has one
+    y = pow(alpha, (P + 1) // 4, P)
+    if y * y % P != alpha:
+        raise ValueError('No point with this x')
+    if y & 1 != odd:
+        y = P - y
+    return (x, y)
+
+
+def _double(p):
+    X, Y, Z = p
+    if not Z or not Y:
+        return INFINITY
+    YY = Y * Y % P
+    S = 4 * X * YY % P
+    M = 3 * X * X % P
+    X3 = (M * M - 2 * S) % P
+    return (X3, (M * (S - X3) - 8 * YY * YY) % P, 2 * Y * Z % P)
+
+
+def _add_affine(p, q):
+    """ Jacobian p plus affine q """
+    X1, Y1, Z1 = p
+    if not Z1:
+        return (q[0], q[1], 1)
+    ZZ = Z1 * Z1 % P
+    H = (q[0] * ZZ - X1) % P
+    R = (q[1] * ZZ * Z1 - Y1) % P
+    if not H:
+        return _double(p) if not R else INFINITY
+    HH = H * H % P
+    HHH = H * HH % P
+    V = X1 * HH % P
+    X3 = (R * R - HHH - 2 * V) % P
+    return (X3, (R * (V - X3) - Y1 * HHH) % P, Z1 * H % P)
+
+
+def _add(p, q):
+    """ Jacobian p plus Jacobian q """
+    if not q[2]:
+        return p
+    if not p[2]:
+        return q
+    X1, Y1, Z1 = p
+    X2, Y2, Z2 = q
+    Z1Z1 = Z1 * Z1 % P
+    Z2Z2 = Z2 * Z2 % P
+    U1 = X1 * Z2Z2 % P
+    S1 = Y1 * Z2 * Z2Z2 % P
+    H = (X2 * Z1Z1 - U1) % P
+    R = (Y2 * Z1 * Z1Z1 - S1) % P
+    if not H:
+        return _double(p) if not R else INFINITY
+    HH = H * H % P
+    HHH = H * HH % P
+    V = U1 * HH % P
+    X3 = (R * R - HHH - 2 * V) % P
+    return (X3, (R * (V - X3) - S1 * HHH) % P, Z1 * Z2 * H % P)
+
+
+def to_affine(p):
+    X, Y, Z = p
+    if not Z:
+        return None
+    z = inverse(Z, P)
+    zz = z * z % P
+    return (X * zz % P, Y * zz * z % P)
+
+
+def normalize(points):
+    """ Jacobian points to affine, with one inversion for all of them """
+    inverses = iter(batch_inverse([Z for _, _, Z in points if Z], P))
+    affine = []
+    for X, Y, Z in points:
+        if not Z:
+            affine.append(None)
+            continue
+        z = next(inverses)
+        zz = z * z % P
+        affine.append((X * zz % P, Y * zz * z % P))
+    return affine
+
+
+def _jacobian_multiples(point, w):
+    """ point, 3 point, 5 point ... (2^(w-1) - 1) point, all Jacobian """
+    twice = _double((point[0], point[1], 1))
+    multiples = [(point[0], point[1], 1)]
+    for _ in range(2 ** (w - 2) - 1):
+        multiples.append(_add(multiples[-1], twice))
+    return multiples
+
+
+def _odd_multiples(point, w):
+    """ point, 3 point, 5 point ... (2^(w-1) - 1) point, all affine """
+    # None are at infinity, the group has prime order
+    return normalize(_jacobian_multiples(point, w))
+
+
+def wnaf(k, w):
+    """ Digits of k in width-w NAF, least significant first """
+    digits = []
+    full = 1 << w
+    half = full >> 1
+    while k:
+        if k & 1:
+            digit = k & (full - 1)
+            if digit >= half:
+                digit -= full
+            k -= digit
+        else:
+            digit = 0
+        digits.append(digit)
+        k >>= 1
+    return digits
+
+
+_G_TABLE = _odd_multiples(G, G_WINDOW)
+
+
+def _straus(terms):
+    """ Sum of k * point over (digits, table) terms, as a Jacobian point """
+    length = max(len(digits) for digits, _ in terms)
+    acc = INFINITY
+    for i in range(length - 1, -1, -1):
+        acc = _double(acc)
+        for digits, table in terms:
+            if i < len(digits) and digits[i]:
+                digit = digits[i]
+                if digit > 0:
+                    acc = _add_affine(acc, table[digit >> 1])
+                else:
+                    x, y = table[-digit >> 1]
+                    acc = _add_affine(acc, (x, P - y))
+    return acc
+
+
+def mul_add(a, b, point):
+    """ a * G + b * point, affine """
+    terms = []
+    if a % N:
+        terms.append((wnaf(a % N, G_WINDOW), _G_TABLE))
+    if b % N and point is not None:
+        terms.append((wnaf(b % N, WINDOW), _odd_multiples(point, WINDOW)))
+    if not terms:
+        return None
+    return to_affine(_straus(terms))
+
+
+def mul(k, point=G):
+    """ k * point, affine """
+    if point == G:
+        return mul_add(k, 0, None)
+    return mul_add(0, k, point)
+
+
+def recover(e, r, s, recid):
+    """
+    The public key of a signature (r, s) of the hash e, as recovery id
+    recid picks it: r^-1 (s R - e G), R being the point with x = r +
+    (recid / 2) n and y of the parity of recid
+    """
+    if not (0 < r < N and 0 < s < N):
+        raise ValueError('Signature out of range')
+    R = lift_x(r + (recid // 2) * N, recid & 1)
+    inv_r = inverse(r, N)
+    Q = mul_add(-e * inv_r % N, s * inv_r % N, R)
+    if Q is None:
+        raise ValueError('Recovered the point at infinity')
+    return Q
+
+
+def recover_many(signatures):
+    """
+    recover() for each (e, r, s, recid): the public key, or the
+    ValueError recover() would raise, in order. The r's are inverted
+    together, then the tables of odd multiples of all the R's, then
+    the keys.
+    """
+    results = [None] * len(signatures)
+    valid = []
+    for i, (e, r, s, recid) in enumerate(signatures):
+        try:
+            if not (0 < r < N and 0 < s < N):
+                raise ValueError('Signature out of range')
+            valid.append((i, e, r, s, lift_x(r + (recid // 2) * N,
+                                             recid & 1)))
+        except ValueError as error:
+            results[i] = error
+
+    inverses = batch_inverse([r for _, _, r, _, _ in valid], N)
+    size = 2 ** (WINDOW - 2)
+    tables = normalize([multiple for _, _, _, _, R in valid
+                        for multiple in _jacobian_multiples(R, WINDOW)])
+    sums = []
+    for k, ((i, e, r, s, R), inv_r) in enumerate(zip(valid, inverses)):
+        # s inv_r isn't 0 mod n, e inv_r may be
+        terms = [(wnaf(s * inv_r % N, WINDOW),
+                  tables[k * size:(k + 1) * size])]
+        if -e * inv_r % N:
+            terms.append((wnaf(-e * inv_r % N, G_WINDOW), _G_TABLE))
+        sums.append(_straus(terms))
+
+    for (i, _, _, _, _), Q in zip(valid, normalize(sums)):
+        results[i] = Q if Q is not None else \
+            ValueError('Recovered the point at infinity')
+    return results
+
+
+def verify(e, r, s, Q):
+    """ Whether (r, s) is a signature of the hash e by the public key Q """
+    if not (0 < r < N and 0 < s < N) or Q is None or not on_curve(Q):
+        return False
+    w = inverse(s, N)
+    terms = [(wnaf(e * w % N, G_WINDOW), _G_TABLE),
+             (wnaf(r * w % N, WINDOW), _odd_multiples(Q, WINDOW))]
+    X, _, Z = _straus([(digits, table) for digits, table in terms
+                       if digits])
+    if not Z:
+        return False
+    # x = X / Z^2 mod P is r or r + n, compared without inverting Z
+    ZZ = Z * Z % P
+    if r * ZZ % P == X:
+        return True
+    return r + N < P and (r + N) * ZZ % P == X
+
+
+def encode_point(point, compressed=False):
+    """ A public key as SEC1 bytes, as hashed into bitcoin addresses """
+    x, y = point
+    x_str = ('%064x' % x).decode('hex')
+    if compressed:
+        return chr(2 + (y & 1)) + x_str
+    return chr(4) + x_str + ('%064x' % y).decode('hex')
@@ -15,6 +15,12 @@ import base64
 from ecdsa.ecdsa import curve_secp256k1, generator_secp256k1
 from ecdsa.curves import SECP256k1
 
+import curvemath
+
+# What verify_message does the curve arithmetic with: 'curvemath', or
+# python-ecdsa's affine points ('ecdsa'), several times slower
+ENGINE = 'curvemath'
+
 #
 # Credit for parts of this code goes to the Electrum bitcoin client https://github.com/spesmilo/electrum
 #
@@ -142,6 +148,23 @@ class EC_KEY(object):
 
     @classmethod
     def verify_message(self, address, signature, message):
+        """
+        The address that signed message, raising if it isn't address
+        (when one is given) or the signature is bad
+        """
+        if ENGINE == 'ecdsa':
+            return self.verify_message_ecdsa(address, signature, message)
+        r, s, recid, compressed, e = _decode_signature(signature, message)
+        Q = curvemath.recover(e, r, s, recid)
+        if not curvemath.verify(e, r, s, Q):
+            raise Exception("Bad signature")
+        addr = public_key_to_bc_address(curvemath.encode_point(Q, compressed))
+        if address and address != addr:
+            raise Exception("Bad signature")
+        return addr
+
+    @classmethod
+    def verify_message_ecdsa(self, address, signature, message):
         """ See http://www.secg.org/download/aid-780/sec1-v2.pdf for the math """
         from ecdsa import numbertheory, ellipticcurve, util
         import msqr
@@ -198,6 +221,70 @@ def sign_message(secret, message):
     return key.sign_message(message, False, generate_btc_address(secret)[3])
 
 
+def _decode_signature(signature, message):
+    """
+    (r, s, recovery id, compressed, hash) of a signature of message,
+    raising like verify_message on a malformed one
+    """
+    from ecdsa import util
+    order = generator_secp256k1.order()
+    try:
+        sig = base64.b64decode(signature)
+    except TypeError:
+        raise Exception("Wrong encoding")
+    if len(sig) != 65:
+        raise Exception("Wrong encoding")
+    r, s = util.sigdecode_string(sig[1:], order)
+    # verify_digest checks these, and r must be invertible
+    if not (0 < r < order and 0 < s < order):
+        raise Exception("Bad signature")
+    nV = ord(sig[0])
+    if nV < 27 or nV >= 35:
+        raise Exception("Bad encoding")
+    compressed = nV >= 31
+    recid = nV - (31 if compressed else 27)
+    try:
+        e = string_to_number(Hash(msg_magic(message)))
+    except UnicodeError:
+        raise Exception("Bad encoding")
+    return r, s, recid, compressed, e
+
+
+def verify_messages(items):
+    """
+    verify_message for many (address, signature, message) triples at
+    once. Returns (address, None) for each good signature and (None,
+    error) for each bad one, in order.
+
+    The keys are recovered together (curvemath.recover_many), with
+    three modular inversions for the whole batch, and aren't checked
+    again with curvemath.verify: a key recovered from (r, s) verifies
+    (r, s) whenever r and s are in range, which _decode_signature
+    checks.
+    """
+    results = [None] * len(items)
+    decoded = []
+    for i, (address, signature, message) in enumerate(items):
+        try:
+            decoded.append((i, _decode_signature(signature, message)))
+        except Exception as e:
+            results[i] = (None, str(e) or e.__class__.__name__)
+
+    keys = curvemath.recover_many([(e, r, s, recid) for _, (r, s, recid, _, e)
+                                   in decoded])
+    for (i, (_, _, _, compressed, _)), Q in zip(decoded, keys):
+        address = items[i][0]
+        if isinstance(Q, ValueError):
+            results[i] = (None, str(Q))
+            continue
+        addr = public_key_to_bc_address(curvemath.encode_point(Q, compressed))
+        if address and address != addr:
+            results[i] = (None, "Bad signature")
+        else:
+            results[i] = (addr, None)
+    return results
+
+
 def generate_btc_address(secret):
     ripehash = hashlib.new('ripemd160')
     # secp256k1, not included in stock ecdsa
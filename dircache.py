@@ -0,0 +1,84 @@
+"""
+dircache.py
+
+Cached directory listings for the forum's static tree. A listing is
+only rebuilt when the directory's own mtime changes, so a request
+costs one stat of the directory instead of a stat per entry. Thread
+files are replaced by rename (util.atomic_write), which updates the
+directory mtime, so rewrites are seen here too.
+"""
+import os
+import stat
+import time
+import bisect
+import threading
+
+# Directory mtimes this close to the last scan may hide a change made
+# in the same clock tick, so such listings are rescanned
+RACY_SECONDS = 1.0
+
+
+class Listing(object):
+    """ Entries of one directory, kept sorted by mtime """
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.scanned_at = 0
+        self.entries = []
+        self.dirs = []
+        self._lock = threading.Lock()
+
+    def is_current(self, st):
+        return (st.st_mtime == self.mtime and
+                st.st_mtime < self.scanned_at - RACY_SECONDS)
+
+    def refresh(self):
+        """ Rescan the directory if it changed since the last scan """
+        st = os.stat(self.path)
+        if self.is_current(st):
+            return self
+
+        with self._lock:
+            if self.is_current(st):
+                return self
+
+            scanned_at = time.time()
+            entries = []
+            dirs = []
+            for name in os.listdir(self.path):
+                try:
+                    entry = os.stat(os.path.join(self.path, name))
+                except OSError:
+                    # Deleted since listdir
+                    continue
+                if stat.S_ISDIR(entry.st_mode):
+                    dirs.append(name)
+                bisect.insort(entries, (entry.st_mtime, name))
+
+            self.entries = entries
+            self.dirs = dirs
+            self.mtime = st.st_mtime
+            self.scanned_at = scanned_at
+        return self
+
+    def by_mtime(self):
+        """ All entries, least recently modified first """
+        return [name for _, name in self.entries]
+
+    def subdirs(self):
+        return list(self.dirs)
+
+
+_listings = {}
+_listings_lock = threading.Lock()
+
+
+def listing(path):
+    """ Return the up to date listing of a directory """
+    path = os.path.normpath(path)
+    with _listings_lock:
+        entry = _listings.get(path)
+        if entry is None:
+            entry = _listings[path] = Listing(path)
+    return entry.refresh()
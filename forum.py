@@ -4,20 +4,28 @@ forum.py
 Defines all the forum operation functions
 """
 import feedparser
-import requests
 import json
 import uuid
 import math
 import os
-import markdown
+import itertools
 
 from datetime import datetime
 from flask import render_template, redirect, url_for, abort,\
-    request, flash, session
-from lockfile import FileLock
-from xml.sax.saxutils import unescape
+    request, flash, session, g
+from xml.sax.saxutils import escape, unescape
 
 import util
+import locks
+import store
+import groupcommit
+import replyqueue
+import postrender
+import pagecache
+import threadindex
+import searchindex
+import authorindex
+import sigverify
 
 from forms import NewThreadForm, ThreadReplyForm
 
@@ -40,56 +48,224 @@ def get_nonce_message():
 
 
 def check_sig(message, signature, btc_addr):
+    """ The address that signed message, or None (see sigverify.py) """
+    return sigverify.verify(message, signature, btc_addr)
+
+
+def page_count(num_posts):
+    """ Number of pages of a thread, the OP doesn't count """
     from main import app
 
-    resp = requests.post(app.config['COIN_API']+'/check_sig',
-                         {'signature': signature,
-                             'message': message,
-                             'btc_addr': btc_addr})
-    if resp.ok:
-        return resp.text
+    numpages = (num_posts - 1) / float(app.config['NUM_POSTS_PER_PAGE'])
+    return int(math.ceil(numpages))
+
+
+def post_url(thread_name, subforum, n):
+    """ Link to post number n on its page of the thread """
+    from main import app
+
+    if n == 1:
+        page, anchor = 1, 1
     else:
-        return None
+        per_page = app.config['NUM_POSTS_PER_PAGE']
+        page = page_count(n)
+        anchor = (n - 2) % per_page + 2
+    return '{}/{}/{}#{}'.format(subforum.rstrip('/'), thread_name, page, anchor)
 
 
-def show_thread(thread_name, page, subforum='/'):
+def search(query, page=1):
+    """ Render a page of posts matching a search query, best first """
     from main import app
 
-    """ Render and return the html of the given page of the given thread """
-    path = os.path.normpath('static' + subforum + '/' + thread_name+'.rss')
-    thread = feedparser.parse(path)
+    per_page = app.config.get('SEARCH_RESULTS_PER_PAGE', 20)
+    index = searchindex.get_index()
+    if index is None:
+        abort(404)
 
-    # If it doesn't load succesfully, 404
-    if not thread.feed:
+    results, total = index.search(query, (page - 1) * per_page, per_page)
+    for result in results:
+        result['url'] = post_url(result['thread'], result['subforum'],
+                                 result['n'])
+    return render_template('search.html', query=query, results=results,
+                           total=total, page=page,
+                           numpages=int(math.ceil(total / float(per_page))))
+
+
+def show_profile(field, value, before=None):
+    """ Render a page of the posts by an author or bitcoin address """
+    from main import app
+
+    index = authorindex.get_index()
+    if index is None:
         abort(404)
 
-    op = thread.entries[-1]
-    start_post = (page-1)*app.config['NUM_POSTS_PER_PAGE'] + 1
-    end_post = (page)*app.config['NUM_POSTS_PER_PAGE'] + 1
-    # TODO: Reversing doesn't scale
-    replies = [x for x in reversed(thread.entries)][start_post:end_post]
+    try:
+        before = int(before) if before else None
+    except ValueError:
+        before = None
+    posts, next_page = index.posts(field, value, before,
+                                   app.config.get('PROFILE_POSTS_PER_PAGE', 20))
+    for post in posts:
+        post['url'] = post_url(post['thread'], post['subforum'], post['n'])
+    return render_template('profile.html', field=field, value=value,
+                           posts=posts, next_page=next_page,
+                           counts=index.counts(field, value))
+
+
+def profile_rss(field, value):
+    """ RSS feed of the latest posts by an author or bitcoin address """
+    from main import app
+
+    index = authorindex.get_index()
+    if index is None:
+        abort(404)
+
+    threads = store.get_store()
+    rows, _ = index.posts(field, value,
+                          limit=app.config.get('PROFILE_POSTS_PER_PAGE', 20))
+    posts = []
+    for row in rows:
+        # The post itself is in its thread
+        for post in threads.posts(row['thread'], row['subforum'],
+                                  row['n'] - 1, row['n']):
+            link = app.config['SITE_ROOT'] + post_url(
+                row['thread'], row['subforum'], row['n'])
+            posts.append(dict(post, link=link))
+
+    # The template doesn't escape, and both carry the name as asked for
+    text = render_template('rss_template.rss', posts=posts,
+                           title=escape('Posts by ' + value),
+                           link=escape(app.config['SITE_ROOT'] + request.path))
+    return app.response_class(text, mimetype='application/rss+xml')
+
+
+def show_thread(thread_name, page, subforum='/'):
+    """ Render and return the html of the given page of the given thread """
+    meta = threadindex.thread('static' + subforum, thread_name)
+    if not meta:
+        return render_thread(thread_name, page, subforum)
+
+    # The index knows when the thread last changed, so a reader's copy
+    # can be confirmed current before anything is read or rendered
+    version = (postrender.RENDERER_VERSION, meta['num_posts'], meta['mtime'],
+               len(pending_replies(thread_name, subforum)))
+    return util.conditional_page(
+        version, lambda: render_thread(thread_name, page, subforum, meta))
+
+
+def render_thread(thread_name, page, subforum='/', meta=None):
+    """ Render a page of a thread, from a snapshot if the reader can share one """
+    from main import app
+
+    if pagecache.enabled() and not session.get('authenticated'):
+        return show_thread_snapshot(thread_name, page, subforum, meta)
+
+    if app.config.get('STREAM_THREAD_PAGES'):
+        render = util.stream_template
+    else:
+        render = render_template
+
+    return render('thread.html',
+                  **thread_page(thread_name, page, subforum))
 
-    numreplies = (len(thread.entries)-1)
-    numpages = numreplies / float(app.config['NUM_POSTS_PER_PAGE'])
-    numpages = int(math.ceil(numpages))
+
+def show_thread_snapshot(thread_name, page, subforum='/', meta=None):
+    """
+    Render a thread page around a snapshot of its content, making
+    and storing the snapshot first if there's no current one
+    """
+    if meta is None:
+        meta = threadindex.thread('static' + subforum, thread_name)
+    if not meta or pending_replies(thread_name, subforum):
+        # Not in the index, don't cache what might be a 404. Queued
+        # replies come and go, pages showing them aren't kept either
+        return render_template('thread.html',
+                               **thread_page(thread_name, page, subforum))
+
+    # Full pages only change when a new page appears, the last one
+    # changes with every reply
+    numpages = page_count(meta['num_posts'])
+    version = (postrender.RENDERER_VERSION, numpages,
+               meta['num_posts'] if page >= numpages else None)
+
+    key = pagecache.thread_key(subforum, thread_name, page)
+    snapshot = pagecache.cache.get(key, version)
+    if snapshot is None:
+        context = thread_page(thread_name, page, subforum)
+        snapshot = {'title': context['title'],
+                    'html': pagecache.render_content('thread.html',
+                                                     **context)}
+        pagecache.cache.set(key, version, snapshot)
 
     return render_template('thread.html',
-                           thread=thread,
+                           snapshot=snapshot['html'],
+                           title=snapshot['title'],
                            thread_name=thread_name,
-                           replies=enumerate(replies),
-                           op=op,
-                           title=op.title,
-                           unescape=unescape,
-                           page=page,
-                           markdown=markdown.markdown,
-                           numpages=numpages,
                            form=ThreadReplyForm())
 
 
+def thread_page(thread_name, page, subforum='/'):
+    """ Template context for a page of a thread, 404s if there's no thread """
+    from main import app
+
+    start_post = (page-1)*app.config['NUM_POSTS_PER_PAGE'] + 1
+    end_post = (page)*app.config['NUM_POSTS_PER_PAGE'] + 1
+
+    threads = store.get_store()
+    info = threads.info(thread_name, subforum)
+
+    # If it doesn't load succesfully, 404
+    if not info:
+        abort(404)
+
+    title, link, num_posts = info
+    op = next(threads.posts(thread_name, subforum, 0, 1))
+    # Only the posts on this page are read
+    replies = threads.posts(thread_name, subforum, start_post, end_post)
+
+    # Queued replies go after the stored ones, numbered as they will be
+    queued = pending_replies(thread_name, subforum)
+    for n, reply in enumerate(queued, num_posts + 1):
+        reply['n'] = n
+        reply['title'] = 'RE [{}]: {}'.format(n, title)
+    on_page = queued[max(start_post - num_posts, 0):
+                     max(end_post - num_posts, 0)]
+    num_posts += len(queued)
+
+    def page_posts():
+        """ (index on page, post, html), produced as the template asks """
+        for i, reply in enumerate(itertools.chain(replies, on_page)):
+            # Html was rendered when the posts were written
+            yield (i, reply, postrender.post_html(reply))
+
+    return dict(thread_name=thread_name,
+                replies=page_posts(),
+                op=op,
+                op_html=postrender.post_html(op),
+                title=op.title,
+                unescape=unescape,
+                page=page,
+                numpages=page_count(num_posts),
+                form=ThreadReplyForm())
+
+
+def pending_replies(thread_name, subforum='/'):
+    """ Replies to a thread still in the reply queue, looked up once a request """
+    if not replyqueue.enabled():
+        return []
+    pending = getattr(g, 'pending_replies', None)
+    if pending is None:
+        pending = g.pending_replies = {}
+    key = (thread_name, subforum)
+    if key not in pending:
+        pending[key] = replyqueue.pending(thread_name, subforum)
+    return list(pending[key])
+
+
 # XXX: Use redis for the userlist, or a public rss feed?
 def set_btc_addr(username, btc_addr):
     """ Atomically add a user to the userlist file """
-    lock = FileLock('userlist')
+    lock = locks.lock('userlist')
     with lock:
         try:
             f = open('users.json', 'r')
@@ -104,14 +280,15 @@ def set_btc_addr(username, btc_addr):
         # No matching user found, add 'im
         users[username] = {'btc_addr': btc_addr}
 
-        f = open('users.json', 'w')
-        f.write(json.dumps(users))
-        f.close()
+        with lock.fenced():
+            f = open('users.json', 'w')
+            f.write(json.dumps(users))
+            f.close()
 
 
 def get_userlist():
     """ Get the list of users from the users.json file """
-    lock = FileLock('userlist')
+    lock = locks.lock('userlist')
 
     with lock:
         try:
@@ -146,36 +323,82 @@ def reply_thread(thread_name, form, subforum='/'):
         flash('Log in to reply')
         return redirect(url_for('thread', thread=thread_name))
 
-    # Okay, we're going to rerender the whole file.
-    # This is inefficient, so we'll have to
-    # figure out a better way of doing this later
-    lock = FileLock(thread_name + '.lock')
-    with lock:
-        path = os.path.normpath('static' + subforum + '/' + thread_name+'.rss')
-        thread = feedparser.parse(path)
-
-        title = thread.feed.title
-        link = thread.feed.link
+    entry = {
+        # Jinja rendering should escape this as unsafe
+        'description': form.text.data,
+        'author': session['username'],
+        'published': str(datetime.now()),  # TODO: Date formatting
+        'link': '',
+        'bit_btcaddress': session['btc_addr'],
+    }
+    postrender.stamp(entry)
+
+    if replyqueue.enabled():
+        # Written to the thread later, on disk in the queue now
+        if not store.get_store().exists(thread_name, subforum):
+            abort(404)
+        replyqueue.submit(thread_name, subforum, entry)
+        return redirect('/')
 
-        entry = {
-            # Jinja rendering should escape this as unsafe
-            'description': form.text.data,
-            'title': 'RE [{}]: {}'.format(len(thread.entries) + 1,
-                                          thread.feed.title),
-            'author': session['username'],
-            'published': str(datetime.now()),  # TODO: Date formatting
-            'link': '',
-            'bit_btcaddress': session['btc_addr'],
-        }
+    # Replies landing on the thread meanwhile go out in the same write,
+    # this returns once ours is on disk
+    replies.submit((thread_name, subforum), entry)
 
-        util.render_thread_rss(thread_name, subforum,
-                               [entry] + thread.entries,
-                               title=title,
-                               link=link)
     # Just redirect to the the root page for now
     return redirect('/')
 
 
+def commit_replies(key, entries):
+    """
+    Append a batch of replies to a thread: one read of the thread, one
+    write and one index update for all of them
+    """
+    thread_name, subforum = key
+
+    lock = locks.lock(thread_name + '.lock')
+    with lock:
+        threads = store.get_store()
+        info = threads.info(thread_name, subforum)
+        if not info:
+            abort(404)
+        title, link, num_posts = info
+
+        for n, entry in enumerate(entries, num_posts + 1):
+            entry['n'] = n
+            entry['title'] = 'RE [{}]: {}'.format(n, title)
+
+        # Another node may have taken over a lease we outlived
+        with lock.fenced():
+            threads.append(thread_name, subforum, entries)
+        searchindex.add_posts(subforum, thread_name, entries)
+        authorindex.add_posts(subforum, thread_name, entries)
+
+        last = entries[-1]
+        threadindex.update('static' + subforum, thread_name,
+                           num_posts=last['n'],
+                           last_author=last['author'],
+                           last_published=last['published'])
+        threadindex.bump_counters('static' + subforum, posts=len(entries),
+                                  published=last['published'])
+        invalidate_pages(thread_name, subforum, last['n'], len(entries))
+
+
+replies = groupcommit.GroupCommit(commit_replies)
+
+
+def invalidate_pages(thread_name, subforum, num_posts, added=1):
+    """
+    Drop the page snapshots that adding posts up to number num_posts
+    outdates: the last page, or every page if they started a new one
+    """
+    numpages = page_count(num_posts)
+    if numpages > page_count(num_posts - added):
+        pagecache.invalidate_thread(subforum, thread_name)
+    else:
+        pagecache.invalidate_thread(subforum, thread_name, numpages)
+    pagecache.invalidate_listing(subforum)
+
+
 def new_thread(form, subforum):
     """ Create a new thread rss file in the /static folder """
     from main import app
@@ -202,10 +425,12 @@ def new_thread(form, subforum):
 
     thread_name = util.filenameify(title)
 
-    lock = FileLock('.' + subforum + thread_name)
+    lock = locks.lock('.' + subforum + thread_name)
     with lock:
 
-        if thread_name in util.find_subforums('static'+subforum):
+        threads = store.get_store()
+        if thread_name in util.find_subforums('static'+subforum) or \
+                threads.exists(thread_name, subforum):
             flash('A thread with that name already exists')
             return redirect('/')
 
@@ -225,8 +450,22 @@ def new_thread(form, subforum):
             print "Failblog"
             abort(400)
 
-        util.render_thread_rss(thread_name, subforum,
-                               [entry], title, link=link)
+        postrender.stamp(entry)
+        with lock.fenced():
+            threads.create(thread_name, subforum, entry, link)
+        searchindex.add_posts(subforum, thread_name, [dict(entry, n=1)])
+        authorindex.add_posts(subforum, thread_name, [dict(entry, n=1)])
+
+        threadindex.update('static' + subforum, thread_name,
+                           title=title,
+                           link=link,
+                           num_posts=1,
+                           op_author=entry['author'],
+                           last_author=entry['author'],
+                           last_published=entry['published'])
+        threadindex.bump_counters('static' + subforum, threads=1, posts=1,
+                                  published=entry['published'])
+        pagecache.invalidate_listing(subforum)
 
     # This is annoying, but just redirect to the root page for now
     flash('Your post went through!')
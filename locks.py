@@ -0,0 +1,254 @@
+"""
+locks.py
+
+Named locks shared by every thread and process of the forum, in place
+of lockfile.FileLock. Each lock is a flock() on a file in LOCK_DIR:
+taking a free lock is one system call, a waiter sleeps in the kernel
+and is woken the moment the lock is released instead of polling, and
+the kernel drops the locks of a process that dies, so a crash can't
+leave a stale lock behind. The lock file names its last holder, for
+looking into a lock that's taking long.
+
+Locks can time out (LockTimeout), and the time spent waiting for and
+holding each lock is counted per name, see stats().
+
+These locks only cover one host. With LOCK_BACKEND = 'redis', lock()
+hands out redislock.RedisLock leases instead, so several web nodes
+can share the thread storage.
+"""
+import os
+import time
+import errno
+import fcntl
+import urllib
+import threading
+import contextlib
+
+import config
+
+LOCK_DIR = getattr(config, 'LOCK_DIR', '.locks')
+
+# Wait forever unless a lock is given a timeout of its own
+DEFAULT_TIMEOUT = getattr(config, 'LOCK_TIMEOUT', None)
+
+# Waits with a timeout poll the lock, backing off up to this long
+MAX_POLL_INTERVAL = 0.01
+
+
+class LockTimeout(Exception):
+    pass
+
+
+class LockLost(Exception):
+    """ A lease ran out, or a newer holder wrote, before we did """
+    pass
+
+
+class Stats(object):
+    """ Wait and hold times of one lock name """
+
+    def __init__(self):
+        self.acquired = 0
+        self.contended = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.hold_total = 0.0
+        self.hold_max = 0.0
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _record(name, **times):
+    with _stats_lock:
+        stats = _stats.get(name)
+        if stats is None:
+            stats = _stats[name] = Stats()
+        if 'wait' in times:
+            stats.acquired += 1
+            stats.contended += times['contended']
+            stats.wait_total += times['wait']
+            stats.wait_max = max(stats.wait_max, times['wait'])
+        if 'hold' in times:
+            stats.hold_total += times['hold']
+            stats.hold_max = max(stats.hold_max, times['hold'])
+        if times.get('timeout'):
+            stats.timeouts += 1
+
+
+def stats():
+    """ {lock name: wait and hold statistics} for this process """
+    with _stats_lock:
+        return dict((name, s.as_dict()) for name, s in _stats.items())
+
+
+def report():
+    """ Lines summing up stats(), the most waited on locks first """
+    lines = []
+    for name, s in sorted(stats().items(), key=lambda i: -i[1]['wait_total']):
+        lines.append('{} acquired {} times, {} contended, {} timeouts; '
+                     'waited {:.3f}s (max {:.3f}s), '
+                     'held {:.3f}s (max {:.3f}s)'.format(
+                         name, s['acquired'], s['contended'], s['timeouts'],
+                         s['wait_total'], s['wait_max'],
+                         s['hold_total'], s['hold_max']))
+    return lines
+
+
+def lock_path(name):
+    return os.path.join(LOCK_DIR, urllib.quote(name, safe='') + '.lock')
+
+
+class Lock(object):
+    """
+    A named lock, used like FileLock:
+
+        with locks.lock('userlist'):
+            ...
+
+    Not reentrant: taking a lock you already hold waits forever.
+    """
+
+    def __init__(self, name, timeout=DEFAULT_TIMEOUT):
+        self.name = name
+        self.timeout = timeout
+        self._fd = None
+        self._acquired_at = None
+
+    def _open(self):
+        try:
+            return os.open(lock_path(self.name), os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            try:
+                os.makedirs(LOCK_DIR)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            return os.open(lock_path(self.name), os.O_RDWR | os.O_CREAT, 0o644)
+
+    def acquire(self, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+
+        # Every acquire gets its own open file, so threads of one
+        # process exclude each other too
+        fd = self._open()
+        start = time.time()
+        contended = False
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                contended = True
+                self._wait(fd, start, timeout)
+        except:
+            os.close(fd)
+            raise
+
+        now = time.time()
+        _record(self.name, wait=now - start, contended=contended)
+        self._fd = fd
+        self._acquired_at = now
+
+        os.ftruncate(fd, 0)
+        os.write(fd, '{} {}\n'.format(os.getpid(), threading.current_thread().name))
+
+    def _wait(self, fd, start, timeout):
+        if timeout is None:
+            # Sleep in the kernel until the holder lets go
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            return
+
+        interval = 0.0005
+        while True:
+            if time.time() - start >= timeout:
+                _record(self.name, timeout=True)
+                raise LockTimeout('Timed out waiting {}s for lock {}'.format(
+                    timeout, self.name))
+            time.sleep(interval)
+            interval = min(interval * 2, MAX_POLL_INTERVAL)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+
+    def fence(self):
+        """
+        Check the lock is still ours before a write. An flock is held
+        for as long as the file is open, so it always is.
+        """
+        pass
+
+    @contextlib.contextmanager
+    def fenced(self):
+        """ Write inside this. Nothing to check for an flock either """
+        yield
+
+    def extend(self, lease=None):
+        """ An flock doesn't run out """
+        pass
+
+    def release(self):
+        fd, self._fd = self._fd, None
+        if fd is None:
+            return
+        _record(self.name, hold=time.time() - self._acquired_at)
+        # Closing the file drops the lock
+        os.close(fd)
+
+    def is_locked(self):
+        return self._fd is not None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def lock(name, timeout=DEFAULT_TIMEOUT):
+    """ The lock called name, not yet taken, of the LOCK_BACKEND kind """
+    if getattr(config, 'LOCK_BACKEND', 'file') in ('redis', 'memory'):
+        import redislock
+        return redislock.RedisLock(name, timeout)
+    return Lock(name, timeout)
+
+
+def holder(name):
+    """ 'pid thread' of the last process to take a lock, or None """
+    try:
+        with open(lock_path(name)) as f:
+            return f.read().strip() or None
+    except IOError:
+        return None
+
+
+if __name__ == '__main__':
+    # python locks.py <name> ...
+    # Show who last held each lock and whether it's held now
+    import sys
+
+    for name in sys.argv[1:]:
+        held = False
+        if os.path.exists(lock_path(name)):
+            fd = os.open(lock_path(name), os.O_RDONLY)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except IOError:
+                held = True
+            finally:
+                os.close(fd)
+        print '{}: {}, last taken by {}'.format(
+            name, 'held' if held else 'free', holder(name))
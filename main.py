@@ -12,6 +12,11 @@ from flask import Flask, render_template, redirect,\
 
 import util
 import forum
+import store
+import pagecache
+import rssparse
+import replyqueue
+import threadindex
 
 from redis_sessions import RedisSessionInterface
 from forms import NewThreadForm, LoginForm, SignupForm, ThreadReplyForm
@@ -38,6 +43,12 @@ def get_app_config():
     return app.config['FORUM_GLOBAL']
 
 
+@app.template_filter('cdata')
+def cdata(text):
+    """ Post text for the CDATA section of a feed """
+    return rssparse.escape_cdata(text)
+
+
 @app.template_global()
 def get_login_nonce():
     return forum.get_nonce_message()
@@ -46,11 +57,53 @@ def get_login_nonce():
 # Generate a new login nonce to sign after every GET request
 @app.before_request
 def generate_session_nonce():
-    if request.method == 'GET':
+    # Static files (feeds, css) don't show a nonce, don't touch the session
+    if request.method == 'GET' and request.endpoint != 'static':
+        # Kept in case we answer 304 and the client shows the old page
+        g.previous_nonce = session.get('nonce')
         session['nonce'] = uuid.uuid4()
         g.login_form = LoginForm()
 
 
+@app.before_first_request
+def start_reply_flusher():
+    """ Write queued replies to their threads from this process """
+    if app.config.get('REPLY_QUEUE') and \
+            app.config.get('REPLY_FLUSHER_THREAD', True):
+        replyqueue.start_flusher(app)
+
+
+@app.before_request
+def refresh_feed():
+    """ Export a thread's feed from the thread store before serving it """
+    filename = (request.view_args or {}).get('filename', '')
+    if request.endpoint == 'static' and filename[-4:] == '.rss':
+        threads = store.get_store()
+        subforum, name = os.path.split('/' + filename)
+        if threads.feed_is_stale(name[:-4], subforum):
+            threads.export_rss(name[:-4], subforum)
+
+
+@app.after_request
+def cache_sealed_segments(response):
+    """
+    Sealed thread segments never change: let them be cached for good,
+    and sent gzipped as they're stored
+    """
+    filename = (request.view_args or {}).get('filename', '')
+    if request.endpoint == 'static' and response.status_code == 200 and \
+            filename.endswith('.json.gz') and '.segments/' in filename:
+        response.headers['Cache-Control'] = \
+            'public, max-age=31536000, immutable'
+        response.vary.add('Accept-Encoding')
+        if 'gzip' in request.headers.get('Accept-Encoding', ''):
+            response.headers['Content-Encoding'] = 'gzip'
+            response.mimetype = 'application/json'
+        else:
+            response.mimetype = 'application/gzip'
+    return response
+
+
 """
 @app.route('/robots.txt')
 def static_from_root():
@@ -102,6 +155,36 @@ def about():
     return render_template('about.html')
 
 
+@app.route('/search', methods=['GET'])
+def search():
+    """ Route for searching the posts """
+    query = request.args.get('q', '')
+    page = request.args.get('page', 1, type=int)
+    return forum.search(query, max(page, 1))
+
+
+@app.route('/user/<username>', methods=['GET'])
+def user_profile(username):
+    """ Route for the posts of a user """
+    return forum.show_profile('author', username, request.args.get('before'))
+
+
+@app.route('/user/<username>/rss', methods=['GET'])
+def user_rss(username):
+    return forum.profile_rss('author', username)
+
+
+@app.route('/address/<btc_addr>', methods=['GET'])
+def address_profile(btc_addr):
+    """ Route for the posts signed by a bitcoin address """
+    return forum.show_profile('address', btc_addr, request.args.get('before'))
+
+
+@app.route('/address/<btc_addr>/rss', methods=['GET'])
+def address_rss(btc_addr):
+    return forum.profile_rss('address', btc_addr)
+
+
 @app.route('/login', methods=['POST'])
 def login():
     print 'authenticating'
@@ -126,19 +209,46 @@ def index(subforum=''):
     if request.method == 'POST':
         return forum.new_thread(NewThreadForm(request.form), subforum=subforum)
 
-    # Figure out what threads and subforums we have
-    # by looking at the directory tree
-    threads = util.find_threads(current_subforum='static' + subforum)
-
-    subforums = util.subforums(current_subforum='static' + subforum)
-
-    # The directory tree to the current subforum
-    return render_template('index.html', threads=threads,
-                           subforums=subforums,
-                           current_subforum='static' + subforum,
-                           config=app.config['FORUM_GLOBAL'],
-                           nonce=forum.get_nonce_message(),
-                           form=NewThreadForm())
+    current_subforum = 'static' + subforum
+    subforums = util.subforums(current_subforum=current_subforum)
+    after = request.args.get('after')
+
+    def listing():
+        # Threads come from the subforum's metadata index,
+        # subforums from the directory tree
+        threads, next_page = threadindex.page(
+            current_subforum=current_subforum,
+            after=after,
+            limit=app.config['THREADS_PER_PAGE'])
+
+        return dict(threads=threads,
+                    next_page=next_page,
+                    subforums=subforums,
+                    current_subforum=current_subforum,
+                    config=app.config['FORUM_GLOBAL'],
+                    nonce=forum.get_nonce_message(),
+                    form=NewThreadForm())
+
+    # The listing is current as long as nothing was posted here or in
+    # the subforums listed
+    version = (threadindex.counters(current_subforum)['mtime'],
+               tuple(forum['mtime'] for forum in subforums))
+
+    def render():
+        if not pagecache.enabled() or session.get('authenticated'):
+            return render_template('index.html', **listing())
+
+        # Logged-out readers get a snapshot
+        key = pagecache.listing_key(subforum, after)
+        snapshot = pagecache.cache.get(key, version)
+        if snapshot is None:
+            snapshot = pagecache.render_content('index.html', **listing())
+            pagecache.cache.set(key, version, snapshot)
+
+        return render_template('index.html', snapshot=snapshot,
+                               form=NewThreadForm())
+
+    return util.conditional_page(version, render)
 
 # Route the main page to the regular one if everything was okay with startup
 # otherwise show an error page
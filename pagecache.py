@@ -0,0 +1,111 @@
+"""
+pagecache.py
+
+Snapshots of the rendered content of thread pages and subforum
+listings, served to logged-out readers. Only the page's content block
+is kept: the navbar, login form and flashes around it differ per
+session and are rendered per request.
+
+Every snapshot is stored with a version describing what it was made
+from (post count, page count, renderer, subforum activity), so a
+snapshot made stale by a write in another process is never served.
+new_thread and reply_thread also drop the snapshots they outdate, so
+only the last page of a thread and the listings get rebuilt.
+"""
+import os
+import threading
+
+from collections import OrderedDict
+from jinja2.utils import concat
+from flask import Markup
+
+import config
+
+
+class PageCache(object):
+    """ LRU of content snapshots, each stored with its version """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        """ The snapshot stored under key, if it has this version """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, version, snapshot):
+        if not self.max_entries:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (version, snapshot)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, predicate):
+        """ Drop every snapshot whose key the predicate accepts """
+        with self._lock:
+            for key in [k for k in self._entries if predicate(k)]:
+                del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+
+cache = PageCache(getattr(config, 'PAGE_CACHE_ENTRIES', 1024))
+
+
+def enabled():
+    return cache.max_entries > 0
+
+
+def _subforum_key(subforum):
+    return os.path.normpath('static' + subforum)
+
+
+def thread_key(subforum, thread_name, page):
+    return ('thread', _subforum_key(subforum), thread_name, page)
+
+
+def listing_key(subforum, after=None):
+    return ('listing', _subforum_key(subforum), after)
+
+
+def render_content(template_name, **context):
+    """ Render only the content block of a template """
+    from main import app
+
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    block = template.blocks['content']
+    return Markup(concat(block(template.new_context(context))))
+
+
+def invalidate_thread(subforum, thread_name, from_page=1):
+    """ Drop the snapshots of a thread's pages from from_page on """
+    path = _subforum_key(subforum)
+    cache.invalidate(lambda k: k[0] == 'thread' and k[1] == path and
+                     k[2] == thread_name and k[3] >= from_page)
+
+
+def invalidate_listing(subforum):
+    """
+    Drop the listings of a subforum and of its parent, whose subforum
+    panel shows this one's counts
+    """
+    path = _subforum_key(subforum)
+    parent = os.path.dirname(path)
+    cache.invalidate(lambda k: k[0] == 'listing' and k[1] in (path, parent))
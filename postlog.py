@@ -0,0 +1,372 @@
+"""
+postlog.py
+
+Append-only post logs for threads. Each thread gets a
+static/<subforum>/<thread>.log file holding one JSON post per
+line, oldest first, so a reply is a single append instead of
+a parse and rewrite of the whole .rss file. The public .rss
+feed is exported from the log when it falls behind.
+
+Next to each log, <thread>.idx holds the byte offset and length
+of every post, so a page can be read by seeking straight to its
+posts.
+"""
+import os
+import sys
+import json
+import struct
+import tempfile
+
+from flask import render_template
+
+import util
+import rssparse
+import postrecord
+
+# Posts of every store are these, see postrecord.py
+from postrecord import Post
+
+# One index record per post: byte offset and length of its log line
+INDEX_RECORD = struct.Struct('<QI')
+
+
+def log_path(thread_name, subforum='/'):
+    """ Path of the post log for a thread """
+    return os.path.normpath('static' + subforum + '/' + thread_name + '.log')
+
+
+def rss_path(thread_name, subforum='/'):
+    """ Path of the public rss feed for a thread """
+    return os.path.normpath('static' + subforum + '/' + thread_name + '.rss')
+
+
+def exists(thread_name, subforum='/'):
+    return os.path.exists(log_path(thread_name, subforum))
+
+
+def index_path(thread_name, subforum='/'):
+    """ Path of the post offset index for a thread """
+    return os.path.normpath('static' + subforum + '/' + thread_name + '.idx')
+
+
+def _unindexed(log, start):
+    """
+    Return (offset, length) for every complete line of the log from
+    byte offset start on. A line without its newline is still being
+    written, so it's left out.
+    """
+    records = []
+    with open(log, 'rb') as f:
+        f.seek(start)
+        pos = start
+        for line in f:
+            if not line.endswith('\n'):
+                break
+            records.append((pos, len(line)))
+            pos += len(line)
+    return records
+
+
+class PostIndex(object):
+    """
+    Offsets of the posts in a thread's log. Posts the index file
+    doesn't cover yet, e.g. logs written before it existed, are
+    found by scanning the end of the log.
+    """
+
+    def __init__(self, thread_name, subforum='/'):
+        self.log = log_path(thread_name, subforum)
+        self.idx = index_path(thread_name, subforum)
+
+        try:
+            self.indexed = os.path.getsize(self.idx) // INDEX_RECORD.size
+        except OSError:
+            self.indexed = 0
+
+        self.tail = []
+        end = 0
+        if self.indexed:
+            offset, length = self.records(self.indexed - 1, self.indexed)[0]
+            end = offset + length
+
+        if end < os.path.getsize(self.log):
+            self.tail = _unindexed(self.log, end)
+            if self.tail:
+                end = self.tail[-1][0] + self.tail[-1][1]
+        # Where the last complete post ends
+        self.end = end
+
+    def __len__(self):
+        return self.indexed + len(self.tail)
+
+    def records(self, start, stop):
+        """ (offset, length) of posts start to stop, like a slice """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        records = []
+        if start < self.indexed:
+            with open(self.idx, 'rb') as f:
+                f.seek(start * INDEX_RECORD.size)
+                count = min(stop, self.indexed) - start
+                data = f.read(count * INDEX_RECORD.size)
+            records = [INDEX_RECORD.unpack_from(data, i * INDEX_RECORD.size)
+                       for i in range(len(data) // INDEX_RECORD.size)]
+        if stop > self.indexed:
+            records += self.tail[max(start - self.indexed, 0):
+                                 stop - self.indexed]
+        return records
+
+    def read(self, start, stop):
+        """ Posts start to stop (0 is the OP), like a slice """
+        return list(self.iter(start, stop))
+
+    def iter(self, start, stop):
+        """ Like read, but reads each post only when it's asked for """
+        records = self.records(start, stop)
+        if not records:
+            return
+        with open(self.log, 'rb') as f:
+            for offset, length in records:
+                f.seek(offset)
+                yield Post(json.loads(f.read(length)))
+
+    def flush_tail(self):
+        """
+        Write the records of the scanned tail to the index file.
+        Only call this while holding the thread lock.
+        """
+        if not self.tail:
+            return
+        with open(self.idx, 'ab') as f:
+            f.truncate(self.indexed * INDEX_RECORD.size)
+            f.write(''.join(INDEX_RECORD.pack(*r) for r in self.tail))
+        self.indexed += len(self.tail)
+        self.tail = []
+
+
+def count_posts(thread_name, subforum='/'):
+    """ Number of posts in a logged thread """
+    return len(PostIndex(thread_name, subforum))
+
+
+def read_range(thread_name, subforum='/', start=0, stop=None):
+    """
+    Return posts start to stop of a thread (0 is the OP), like
+    slicing read_posts() but reading only those posts
+    """
+    return PostIndex(thread_name, subforum).read(start, stop)
+
+
+def thread_info(thread_name, subforum='/'):
+    """
+    Return (title, link, num_posts) for a logged thread, or None
+    if it has no log. Only the OP is read.
+    """
+    if not exists(thread_name, subforum):
+        return None
+
+    index = PostIndex(thread_name, subforum)
+    if not len(index):
+        return None
+    op = index.read(0, 1)[0]
+
+    return op['title'], op.get('feed_link', ''), len(index)
+
+
+def append_post(thread_name, subforum, entry):
+    """
+    Append a post to the thread log and its index, and make sure it
+    hits the disk. The caller holds the thread lock and sets entry['n'].
+    """
+    append_posts(thread_name, subforum, [entry])
+
+
+def append_posts(thread_name, subforum, entries):
+    """
+    Like append_post for several posts at once, with one write and
+    one fsync for all of them
+    """
+    lines = [json.dumps(postrecord.as_dict(entry)) + '\n'
+             for entry in entries]
+    path = log_path(thread_name, subforum)
+
+    offset = 0
+    if os.path.exists(path):
+        index = PostIndex(thread_name, subforum)
+        index.flush_tail()
+        offset = index.end
+
+    f = open(path, 'ab')
+    try:
+        # Drop what's left of a post we crashed while writing
+        f.truncate(offset)
+        f.write(''.join(lines))
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+
+    # The log is the source of truth; if we die before this the records
+    # are rebuilt from the log by the next PostIndex
+    records = []
+    for line in lines:
+        records.append(INDEX_RECORD.pack(offset, len(line)))
+        offset += len(line)
+    with open(index_path(thread_name, subforum), 'ab') as f:
+        f.write(''.join(records))
+
+
+def rewrite(thread_name, subforum, posts):
+    """
+    Replace a thread's log and index with the given posts, e.g. to
+    update stored fields of old posts. The caller holds the thread lock.
+    """
+    write_log(thread_name, subforum, posts)
+
+
+def write_log(thread_name, subforum, posts):
+    """
+    Like rewrite, but takes any iterable of posts and writes them out
+    as they come, so a thread never has to be in memory whole
+    """
+    log = log_path(thread_name, subforum)
+    idx = index_path(thread_name, subforum)
+    log_fd, log_tmp = tempfile.mkstemp(dir=os.path.dirname(log),
+                                       prefix='.' + os.path.basename(log))
+    idx_fd, idx_tmp = tempfile.mkstemp(dir=os.path.dirname(idx),
+                                       prefix='.' + os.path.basename(idx))
+    try:
+        with os.fdopen(log_fd, 'wb') as log_f:
+            with os.fdopen(idx_fd, 'wb') as idx_f:
+                offset = 0
+                for post in posts:
+                    line = json.dumps(postrecord.as_dict(post)) + '\n'
+                    log_f.write(line)
+                    idx_f.write(INDEX_RECORD.pack(offset, len(line)))
+                    offset += len(line)
+                for f in (log_f, idx_f):
+                    f.flush()
+                    os.fsync(f.fileno())
+        os.chmod(log_tmp, 0o644)
+        os.chmod(idx_tmp, 0o644)
+        os.rename(log_tmp, log)
+        os.rename(idx_tmp, idx)
+    except:
+        for tmp in (log_tmp, idx_tmp):
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+        raise
+
+
+def read_posts(thread_name, subforum='/'):
+    """ Return every post of a thread, oldest first """
+    return read_log(log_path(thread_name, subforum))
+
+
+def read_log(path):
+    """ Return every post in a post log file, oldest first """
+    posts = []
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                posts.append(Post(json.loads(line)))
+    return posts
+
+
+def import_rss(thread_name, subforum='/'):
+    """
+    Seed a post log from an existing .rss thread, so threads created
+    before switching THREAD_STORAGE to 'log' keep working.
+    Returns False if there is no such thread.
+    """
+    thread = rssparse.parse(rss_path(thread_name, subforum))
+    if not thread.feed or not thread.entries:
+        return False
+
+    lines = []
+    for n, entry in enumerate(reversed(thread.entries), 1):
+        post = {
+            'n': n,
+            'description': entry.get('description', ''),
+            'title': entry.get('title', ''),
+            'author': entry.get('author', ''),
+            'published': entry.get('published', ''),
+            'link': entry.get('link', ''),
+            'bit_btcaddress': entry.get('bit_btcaddress', ''),
+        }
+        if n == 1:
+            post['feed_link'] = thread.feed.get('link', '')
+        lines.append(json.dumps(post) + '\n')
+
+    util.atomic_write(log_path(thread_name, subforum), ''.join(lines))
+    # Any index left lying around belongs to some other log
+    if os.path.exists(index_path(thread_name, subforum)):
+        os.unlink(index_path(thread_name, subforum))
+    return True
+
+
+def feed_behind(rss, mtime):
+    """
+    Whether the feed at rss is missing or older than mtime, the time of
+    what it's exported from. utime keeps only microseconds of the time
+    an export stamps the feed with, so it can come out a hair earlier.
+    """
+    if not os.path.exists(rss):
+        return True
+    return os.stat(rss).st_mtime < mtime - 1e-6
+
+
+def is_stale(thread_name, subforum='/'):
+    """ Whether the .rss feed is behind the post log """
+    return feed_behind(rss_path(thread_name, subforum),
+                       os.stat(log_path(thread_name, subforum)).st_mtime)
+
+
+def export_rss(thread_name, subforum='/'):
+    """
+    Render the public .rss feed of a thread from its post log.
+    Needs an app context for render_template.
+    """
+    log = log_path(thread_name, subforum)
+    # Stamp the feed with the log's mtime as it was before we read it,
+    # so a reply landing mid-export leaves the feed marked stale
+    log_mtime = os.stat(log).st_mtime
+    posts = read_posts(thread_name, subforum)
+    if not posts:
+        return
+
+    op = posts[0]
+    text = render_template('rss_template.rss',
+                           posts=reversed(posts),
+                           title=op['title'],
+                           link=op.get('feed_link', ''))
+
+    rss = rss_path(thread_name, subforum)
+    util.atomic_write(rss, text, encoding='utf-8')
+    os.utime(rss, (log_mtime, log_mtime))
+
+
+def refresh_feeds(current_subforum='static'):
+    """ Re-export the feeds of every thread in a subforum whose log moved on """
+    subforum = current_subforum[len('static'):] or '/'
+    for name in util.sorted_ls(current_subforum):
+        if name[-4:] != '.log':
+            continue
+        thread_name = name[:-4]
+        if is_stale(thread_name, subforum):
+            export_rss(thread_name, subforum)
+
+
+def refresh_all(current_subforum='static'):
+    """ refresh_feeds for a subforum and everything below it """
+    refresh_feeds(current_subforum)
+    for name in util.find_subforums(current_subforum):
+        refresh_all(os.path.join(current_subforum, name))
+
+
+if __name__ == '__main__':
+    # python postlog.py [static_dir]
+    # Export every feed that is behind its post log, e.g. from cron
+    from main import app
+
+    with app.app_context():
+        refresh_all(sys.argv[1] if len(sys.argv) > 1 else 'static')
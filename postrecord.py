@@ -0,0 +1,176 @@
+"""
+postrecord.py
+
+The record every thread store hands out for a post. A parsed thread
+used to be a list of dicts (FeedParserDicts before that), each with a
+hash table of its own and every field decoded up front. A Post keeps
+its fields in __slots__ instead, so its size is fixed whatever it
+holds, and the title and text of a post read from a file can stay in
+that file as offsets (TextSlice) until something reads them: a cached
+thread whose html is already rendered never decodes its posts' text.
+
+Posts still act as the dicts and feed entries they replace, so
+templates and the stores use post['title'], post.author, post.get(),
+dict(post) and post.summary as before. Fields outside FIELDS are kept
+in a dict made only for posts that have them.
+"""
+import sys
+
+import util
+
+
+class TextSlice(object):
+    """ Text of a post at data[start:stop], decoded when first read """
+
+    __slots__ = ('data', 'start', 'stop', 'decode')
+
+    def __init__(self, data, start, stop, decode):
+        self.data = data
+        self.start = start
+        self.stop = stop
+        self.decode = decode
+
+    def text(self):
+        return self.decode(self.data[self.start:self.stop])
+
+
+class Post(object):
+    """
+    A post: Post(mapping or (key, value) pairs, **fields), or a copy
+    of another Post, sharing its text
+    """
+
+    FIELDS = ('n', 'title', 'author', 'published', 'link', 'bit_btcaddress',
+              'description', 'html', 'renderer', 'feed_link')
+
+    __slots__ = ('n', '_title', 'author', 'published', 'link',
+                 'bit_btcaddress', '_description', 'html', 'renderer',
+                 'feed_link', '_extra')
+
+    def __init__(self, fields=(), **more):
+        self._extra = None
+        if isinstance(fields, Post):
+            for slot in Post.__slots__:
+                try:
+                    setattr(self, slot, getattr(fields, slot))
+                except AttributeError:
+                    pass
+            if fields._extra:
+                self._extra = dict(fields._extra)
+            fields = ()
+        elif hasattr(fields, 'keys'):
+            fields = [(key, fields[key]) for key in fields.keys()]
+        for key, value in fields:
+            self[key] = value
+        for key, value in more.items():
+            self[key] = value
+
+    # Title and text can be slices of the file the post came from
+    def _get_title(self):
+        if type(self._title) is TextSlice:
+            self._title = self._title.text()
+        return self._title
+
+    def _set_title(self, value):
+        self._title = value
+
+    title = property(_get_title, _set_title)
+
+    def _get_description(self):
+        if type(self._description) is TextSlice:
+            self._description = self._description.text()
+        return self._description
+
+    def _set_description(self, value):
+        self._description = value
+
+    description = property(_get_description, _set_description)
+
+    def __getattr__(self, name):
+        # Only called for what isn't a set field
+        if name == 'summary':
+            # feedparser sanitizes descriptions, keep doing the same
+            return util.sanitize_html(self.description)
+        if name != '_extra' and self._extra and name in self._extra:
+            return self._extra[name]
+        raise AttributeError(name)
+
+    def __getitem__(self, key):
+        if key in Post.FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in Post.FIELDS:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __contains__(self, key):
+        if key in Post.FIELDS:
+            # Without decoding a slice to see it's there
+            try:
+                getattr(self, _SLOTS.get(key, key))
+            except AttributeError:
+                return False
+            return True
+        return bool(self._extra) and key in self._extra
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = [key for key in Post.FIELDS if key in self]
+        if self._extra:
+            keys.extend(self._extra)
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def as_dict(self):
+        """ The post as a plain dict, e.g. for json """
+        return dict(self.items())
+
+    def __repr__(self):
+        return 'Post({!r})'.format(self.as_dict())
+
+
+# Fields kept under another name
+_SLOTS = {'title': '_title', 'description': '_description'}
+
+
+def as_dict(post):
+    """ A plain dict of a Post or any other mapping of fields """
+    return post.as_dict() if isinstance(post, Post) else post
+
+
+def overhead(post):
+    """
+    Bytes a post's record takes on top of its field values: the Post
+    and any text slices and extra fields dict it holds
+    """
+    size = sys.getsizeof(post)
+    for slot in ('_title', '_description'):
+        value = getattr(post, slot, None)
+        if type(value) is TextSlice:
+            size += sys.getsizeof(value)
+    if post._extra:
+        size += sys.getsizeof(post._extra)
+    return size
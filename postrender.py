@@ -0,0 +1,141 @@
+"""
+postrender.py
+
+Renders post text to html once, when the post is written, instead of
+running markdown on every post of every page view. The html is stored
+next to the raw text with the RENDERER_VERSION that made it: in the
+post record for post logs and the sqlite store, and in
+static/<subforum>/<thread>.rendered for rss threads. Stored html from
+another renderer version is ignored and the post rendered on the fly
+until 'python postrender.py' catches the stored html up.
+"""
+import os
+import sys
+import json
+import threading
+import markdown
+
+import util
+import locks
+import postlog
+import rssparse
+import threadcache
+
+# Bump this when render() changes output, so stored html gets redone
+RENDERER_VERSION = 1
+
+_local = threading.local()
+
+
+def _markdown(text):
+    """ Convert markdown with a per-thread, reused Markdown instance """
+    md = getattr(_local, 'md', None)
+    if md is None:
+        md = _local.md = markdown.Markdown()
+    return md.reset().convert(text)
+
+
+def render(text):
+    """ Html of a post from its raw text, sanitized like the rss feed """
+    return _markdown(util.sanitize_html(text))
+
+
+def stamp(entry):
+    """ Add the rendered html of a new post's description to it """
+    entry['html'] = render(entry['description'])
+    entry['renderer'] = RENDERER_VERSION
+    return entry
+
+
+def rendered_path(thread_name, subforum='/'):
+    return os.path.normpath('static' + subforum + '/' + thread_name +
+                            '.rendered')
+
+
+def _read_rendered(path):
+    """ {post number: (renderer version, html)} from a .rendered file """
+    rendered = {}
+    if not os.path.exists(path):
+        return rendered
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.endswith('\n'):
+                # Still being written
+                break
+            record = json.loads(line)
+            rendered[record['n']] = (record['renderer'], record['html'])
+    return rendered
+
+
+def load_rendered(thread_name, subforum='/'):
+    """ Stored html of an rss thread's posts, by post number """
+    return threadcache.load(rendered_path(thread_name, subforum),
+                            _read_rendered)
+
+
+def append_rendered(thread_name, subforum, n, entry):
+    """
+    Store the html of post number n of an rss thread. Later lines win,
+    so re-rendering is an append too. The caller holds the thread lock.
+    """
+    line = json.dumps({'n': n,
+                       'renderer': entry['renderer'],
+                       'html': entry['html']}) + '\n'
+    with open(rendered_path(thread_name, subforum), 'ab') as f:
+        f.write(line)
+
+
+def post_html(post):
+    """ Html of a post as stored, or rendered now if that's out of date """
+    if post.get('renderer') == RENDERER_VERSION:
+        return post['html']
+    # summary is already sanitized
+    return _markdown(post.summary)
+
+
+def rerender_log(thread_name, subforum='/'):
+    """ Redo the stored html of a logged thread's out of date posts """
+    posts = postlog.read_posts(thread_name, subforum)
+    stale = [p for p in posts if p.get('renderer') != RENDERER_VERSION]
+    for post in stale:
+        stamp(post)
+    if stale:
+        postlog.rewrite(thread_name, subforum, posts)
+    return len(stale)
+
+
+def rerender_rss(thread_name, subforum='/'):
+    """ Redo the stored html of an rss thread's out of date posts """
+    thread = rssparse.parse(postlog.rss_path(thread_name, subforum))
+    rendered = _read_rendered(rendered_path(thread_name, subforum))
+    count = 0
+    for n, entry in enumerate(reversed(thread.entries), 1):
+        if rendered.get(n, (None,))[0] == RENDERER_VERSION:
+            continue
+        html = render(entry.get('description', ''))
+        append_rendered(thread_name, subforum, n,
+                        {'renderer': RENDERER_VERSION, 'html': html})
+        count += 1
+    return count
+
+
+def rerender_all(current_subforum='static'):
+    """ Bring the stored html of every thread up to RENDERER_VERSION """
+    import store
+
+    threads = store.get_store()
+    subforum = os.path.normpath(current_subforum)[len('static'):] or '/'
+    for thread_name in threads.threads(subforum):
+        with locks.lock(thread_name + '.lock'):
+            count = threads.rerender(thread_name, subforum)
+        if count:
+            print 'Rendered {} posts of {}'.format(
+                count, os.path.join(current_subforum, thread_name))
+
+    for name in util.find_subforums(current_subforum):
+        rerender_all(os.path.join(current_subforum, name))
+
+
+if __name__ == '__main__':
+    # python postrender.py [static_dir]
+    rerender_all(sys.argv[1] if len(sys.argv) > 1 else 'static')
@@ -0,0 +1,377 @@
+"""
+redislock.py
+
+Named locks shared by several web nodes, for LOCK_BACKEND = 'redis'.
+They use the Redis server the sessions already live in
+(app.session_interface.redis), so nodes pointing at the same thread
+storage also agree on who may write it.
+
+A lock is a lease: a key set with NX and a PX expiry of LOCK_LEASE
+seconds, so a node that dies holding it only blocks the others until
+the lease runs out. While a lock is held, a thread of the process
+renews its lease every third of LOCK_LEASE, so long writes and flushes
+keep it; should a renewal find the lease gone, the lock is lost.
+
+Every grant also gets a fencing token from an INCR counter, strictly
+larger than any earlier grant of that lock. The holder writes inside
+fenced(): that fails with LockLost if the lock was lost, and otherwise
+holds the storage's own fence for the lock, a file in FENCE_DIR with
+the last token written under it. A write with an older token than that
+is refused, so a node that stalled past its lease, even one that
+passed the Redis check just before stalling, can't overwrite newer
+data. FENCE_DIR has to live on the thread storage the nodes share. If
+the Redis counters are ever lost, empty it before starting again.
+
+LOCK_BACKEND = 'memory' gives the same leases and tokens inside one
+process, for trying this out without a Redis server. There's no other
+writer to fence off then, and the tokens start over with the process,
+so the storage's fence isn't used.
+"""
+import os
+import sys
+import time
+import uuid
+import errno
+import fcntl
+import random
+import socket
+import urllib
+import threading
+import contextlib
+
+import config
+import locks
+
+LEASE = getattr(config, 'LOCK_LEASE', 30)
+FENCE_DIR = getattr(config, 'FENCE_DIR', '.fences')
+
+# Waiters retry with a jittered backoff up to this long
+MAX_RETRY_INTERVAL = 0.05
+
+ACQUIRE = """
+if redis.call('set', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return redis.call('incr', KEYS[2])
+end
+return false
+"""
+
+RELEASE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+EXTEND = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+FENCE = """
+if redis.call('get', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if tonumber(ARGV[2]) < tonumber(redis.call('get', KEYS[2]) or '0') then
+    return 0
+end
+redis.call('set', KEYS[2], ARGV[2])
+return 1
+"""
+
+
+class RedisLeases(object):
+    """ Leases and fencing tokens kept in Redis, each step one script """
+
+    # Tokens are shared by the nodes and outlive the processes
+    storage_fence = True
+
+    def __init__(self, redis, prefix='lock:'):
+        self.prefix = prefix
+        self._acquire = redis.register_script(ACQUIRE)
+        self._release = redis.register_script(RELEASE)
+        self._extend = redis.register_script(EXTEND)
+        self._fence = redis.register_script(FENCE)
+
+    def _keys(self, name, *kinds):
+        return [self.prefix + kind + name for kind in kinds]
+
+    def acquire(self, name, holder, lease):
+        """ The new fencing token if the lease was granted, else None """
+        return self._acquire(keys=self._keys(name, '', 'token:'),
+                             args=[holder, int(lease * 1000)])
+
+    def release(self, name, holder):
+        return bool(self._release(keys=self._keys(name, ''), args=[holder]))
+
+    def extend(self, name, holder, lease):
+        return bool(self._extend(keys=self._keys(name, ''),
+                                 args=[holder, int(lease * 1000)]))
+
+    def fence(self, name, holder, token):
+        return bool(self._fence(keys=self._keys(name, '', 'fence:'),
+                                args=[holder, token]))
+
+
+class MemoryLeases(object):
+    """ RedisLeases for a single process, without a server """
+
+    storage_fence = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._held = {}
+        self._tokens = {}
+        self._fences = {}
+
+    def _holds(self, name, holder):
+        held = self._held.get(name)
+        return held is not None and held[0] == holder and held[1] > time.time()
+
+    def acquire(self, name, holder, lease):
+        with self._lock:
+            held = self._held.get(name)
+            if held is not None and held[1] > time.time():
+                return None
+            self._held[name] = (holder, time.time() + lease)
+            token = self._tokens[name] = self._tokens.get(name, 0) + 1
+            return token
+
+    def release(self, name, holder):
+        with self._lock:
+            if not self._holds(name, holder):
+                return False
+            del self._held[name]
+            return True
+
+    def extend(self, name, holder, lease):
+        with self._lock:
+            if not self._holds(name, holder):
+                return False
+            self._held[name] = (holder, time.time() + lease)
+            return True
+
+    def fence(self, name, holder, token):
+        with self._lock:
+            if not self._holds(name, holder):
+                return False
+            if token < self._fences.get(name, 0):
+                return False
+            self._fences[name] = token
+            return True
+
+
+_memory = MemoryLeases()
+_redis_leases = {}
+
+
+def leases():
+    """ The lease store LOCK_BACKEND names """
+    if getattr(config, 'LOCK_BACKEND', 'file') == 'memory':
+        return _memory
+
+    from main import app
+
+    redis = app.session_interface.redis
+    if id(redis) not in _redis_leases:
+        _redis_leases[id(redis)] = RedisLeases(redis)
+    return _redis_leases[id(redis)]
+
+
+def fence_path(name):
+    return os.path.join(FENCE_DIR, urllib.quote(name, safe='') + '.fence')
+
+
+def _open_fence(name):
+    try:
+        return os.open(fence_path(name), os.O_RDWR | os.O_CREAT, 0o644)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        try:
+            os.makedirs(FENCE_DIR)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        return os.open(fence_path(name), os.O_RDWR | os.O_CREAT, 0o644)
+
+
+@contextlib.contextmanager
+def storage_fence(name, token):
+    """
+    Hold the storage's fence for lock name while writing under token.
+    Raises LockLost if something was written under a newer token.
+    """
+    fd = _open_fence(name)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        last = os.read(fd, 32).strip()
+        if last and token < int(last):
+            raise locks.LockLost('Lock {} token {} is older than {}, '
+                                 'written already'.format(name, token, last))
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.ftruncate(fd, 0)
+        os.write(fd, '{}\n'.format(token))
+        yield
+    finally:
+        # Closing the file drops the flock
+        os.close(fd)
+
+
+class Renewer(object):
+    """ A thread renewing the leases this process holds """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._held = set()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def add(self, lock):
+        with self._lock:
+            self._held.add(lock)
+            # A forked worker doesn't inherit the thread
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self.run,
+                                                name='lock-renewer')
+                self._thread.daemon = True
+                self._thread.start()
+        self._wakeup.set()
+
+    def discard(self, lock):
+        with self._lock:
+            self._held.discard(lock)
+
+    def run(self):
+        while True:
+            self._wakeup.clear()
+            with self._lock:
+                held = list(self._held)
+            wait = None
+            for lock in held:
+                if lock._renewed_at + lock.lease / 3.0 <= time.time():
+                    lock._renew()
+                # A renewal that failed is retried sooner
+                due = max(lock._renewed_at + lock.lease / 3.0,
+                          time.time() + lock.lease / 10.0)
+                wait = min(wait, due) if wait is not None else due
+            self._wakeup.wait(max(wait - time.time(), 0)
+                              if wait is not None else None)
+
+
+_renewer = Renewer()
+
+
+class RedisLock(object):
+    """ A named lease with a fencing token, used like locks.Lock """
+
+    def __init__(self, name, timeout=locks.DEFAULT_TIMEOUT, lease=LEASE):
+        self.name = name
+        self.timeout = timeout
+        self.lease = lease
+        self.token = None
+        self.lost = False
+        self._holder = None
+        self._acquired_at = None
+        self._renewed_at = None
+
+    def acquire(self, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+
+        store = leases()
+        holder = '{}:{}:{}'.format(socket.gethostname(), os.getpid(),
+                                   uuid.uuid4().hex)
+        start = time.time()
+        contended = False
+        interval = 0.001
+        while True:
+            token = store.acquire(self.name, holder, self.lease)
+            if token is not None:
+                break
+            contended = True
+            if timeout is not None and time.time() - start >= timeout:
+                locks._record(self.name, timeout=True)
+                raise locks.LockTimeout(
+                    'Timed out waiting {}s for lock {}'.format(timeout,
+                                                               self.name))
+            # Jitter so the nodes waiting on a lock don't retry in step
+            time.sleep(interval * random.uniform(0.5, 1.5))
+            interval = min(interval * 2, MAX_RETRY_INTERVAL)
+
+        now = time.time()
+        locks._record(self.name, wait=now - start, contended=contended)
+        self.token = int(token)
+        self.lost = False
+        self._holder = holder
+        self._acquired_at = now
+        self._renewed_at = now
+        _renewer.add(self)
+
+    def extend(self, lease=None):
+        """ Renew the lease now, raising LockLost if it already ran out """
+        holder = self._holder
+        if not leases().extend(self.name, holder, lease or self.lease):
+            if holder == self._holder:
+                self.lost = True
+            raise locks.LockLost('Lease on {} ran out'.format(self.name))
+        self._renewed_at = time.time()
+
+    def _renew(self):
+        """ extend() for the renewer, which keeps going whatever happens """
+        if self._holder is None:
+            return
+        try:
+            self.extend()
+        except locks.LockLost as e:
+            _renewer.discard(self)
+            sys.stderr.write('{}\n'.format(e))
+        except Exception as e:
+            # The lease may still be good, try again next round
+            sys.stderr.write('Renewing lock {} failed: {!r}\n'.format(
+                self.name, e))
+
+    def fence(self):
+        """
+        Check that this is still the newest holder right before a
+        write, raising LockLost if it isn't
+        """
+        if self.lost or not leases().fence(self.name, self._holder,
+                                           self.token):
+            raise locks.LockLost('Lost lock {} (token {})'.format(
+                self.name, self.token))
+
+    @contextlib.contextmanager
+    def fenced(self):
+        """
+        Write inside this: fence(), then the storage's fence for as
+        long as the write takes
+        """
+        self.fence()
+        if not leases().storage_fence:
+            yield
+            return
+        with storage_fence(self.name, self.token):
+            yield
+
+    def release(self):
+        holder, self._holder = self._holder, None
+        if holder is None:
+            return
+        _renewer.discard(self)
+        locks._record(self.name, hold=time.time() - self._acquired_at)
+        # Does nothing if the lease already ran out and went to another
+        leases().release(self.name, holder)
+
+    def is_locked(self):
+        return self._holder is not None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
@@ -0,0 +1,357 @@
+"""
+replyqueue.py
+
+Write-behind replies. With REPLY_QUEUE set, reply_thread only renders
+the reply and appends it to a durable queue, then answers; a flusher
+applies queued replies to the thread store in order, in batches per
+thread (forum.commit_replies), and drops them from the queue. So the
+time to reply no longer depends on how big the thread is.
+
+Until a reply is flushed, thread pages merge it in after the stored
+posts. The queue is:
+
+    'redis'   - a list in the session Redis. Durable as far as the
+                server's persistence is, appendfsync always for every
+                reply to survive a crash
+    'journal' - REPLY_JOURNAL, one JSON reply per line, fsynced before
+                the reply is acknowledged. One host only
+
+The flusher runs as a thread in each web process (REPLY_FLUSHER_THREAD)
+or on its own with 'python replyqueue.py'; a lock makes sure only one
+flushes at a time. Replies are matched to stored posts by author and
+timestamp, so a flush that died between writing the thread and
+taking them off the queue doesn't post them twice. Every reply has an
+id, and a flush takes off the queue exactly the replies it applied:
+should two flushers ever overlap, neither drops what the other hasn't
+written yet.
+
+A thread whose replies fail to go in (a lock timing out, a feed that
+won't parse) keeps them queued and shown while the other threads' go
+on being flushed. After failing for REPLY_DEAD_AFTER seconds they're
+parked in a dead letter list ('replies:dead', or REPLY_JOURNAL with
+'.dead' added) to be looked into, and taken off the queue.
+
+Thread pages look up the replies queued to their thread alone: the
+'redis' queue keeps a list per thread alongside the queue, the
+'journal' one an index by thread of each version of the journal.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import threading
+import collections
+
+import util
+import store
+import locks
+import postlog
+import threadcache
+
+QUEUE_KEY = 'replies:queue'
+DEAD_KEY = 'replies:dead'
+
+# Replies applied per flush
+FLUSH_BATCH = 500
+
+
+def _thread_key(thread_name, subforum):
+    return 'replies:thread:{}:{}'.format(subforum, thread_name)
+
+
+class RedisQueue(object):
+    """
+    Queued replies as a Redis list, oldest first, and a list of them
+    per thread
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    def push(self, record):
+        raw = json.dumps(record)
+        pipe = self.redis.pipeline()
+        pipe.rpush(QUEUE_KEY, raw)
+        pipe.rpush(_thread_key(record['thread'], record['subforum']), raw)
+        pipe.execute()
+
+    def peek(self, limit=None):
+        """ (raw, record) of the oldest replies, up to limit of them """
+        stop = -1 if limit is None else limit - 1
+        return [(raw, json.loads(raw))
+                for raw in self.redis.lrange(QUEUE_KEY, 0, stop)]
+
+    def thread_records(self, thread_name, subforum):
+        """ Records of the replies queued to one thread, oldest first """
+        return [json.loads(raw) for raw in
+                self.redis.lrange(_thread_key(thread_name, subforum), 0, -1)]
+
+    def ack(self, acked):
+        """ Take the given (raw, record) off the queue, and only them """
+        self._remove(self.redis.pipeline(), acked)
+
+    def park(self, failed):
+        """ Move the given (raw, record) to the dead letter list """
+        pipe = self.redis.pipeline()
+        for raw, _ in failed:
+            pipe.rpush(DEAD_KEY, raw)
+        self._remove(pipe, failed)
+
+    def _remove(self, pipe, records):
+        for raw, record in records:
+            pipe.lrem(QUEUE_KEY, raw, 1)
+            pipe.lrem(_thread_key(record['thread'], record['subforum']),
+                      raw, 1)
+        pipe.execute()
+
+
+class Journal(object):
+    """ A version of the journal: (raw, record) in order, and by thread """
+
+    def __init__(self, records):
+        self.records = records
+        self.by_thread = {}
+        for raw, record in records:
+            key = (record['thread'], record['subforum'])
+            self.by_thread.setdefault(key, []).append(record)
+
+
+def _read_journal(path):
+    records = []
+    if not os.path.exists(path):
+        return Journal(records)
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.endswith('\n'):
+                # Torn by a crash mid-append, never acknowledged
+                break
+            records.append((line[:-1], json.loads(line)))
+    return Journal(records)
+
+
+class JournalQueue(object):
+    """ Queued replies as lines of a local file, oldest first """
+
+    def __init__(self, path):
+        self.path = path
+
+    def push(self, record):
+        with locks.lock(self.path):
+            with open(self.path, 'a+b') as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell():
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != '\n':
+                        # Drop a line torn by a crash, or this one's lost too
+                        f.seek(0)
+                        f.truncate(f.read().rfind('\n') + 1)
+                f.write(json.dumps(record) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _journal(self):
+        # Parsed once per version of the file
+        return threadcache.load(self.path, _read_journal)
+
+    def peek(self, limit=None):
+        return self._journal().records[:limit]
+
+    def thread_records(self, thread_name, subforum):
+        return list(self._journal().by_thread.get((thread_name, subforum),
+                                                  []))
+
+    def ack(self, acked):
+        acked = collections.Counter(raw + '\n' for raw, _ in acked)
+        with locks.lock(self.path):
+            with open(self.path, 'rb') as f:
+                lines = f.readlines()
+            kept = []
+            for line in lines:
+                if acked[line] > 0:
+                    acked[line] -= 1
+                else:
+                    kept.append(line)
+            util.atomic_write(self.path, ''.join(kept))
+
+    def park(self, failed):
+        """ Move the given (raw, record) to the dead letter file """
+        with open(self.path + '.dead', 'ab') as f:
+            f.write(''.join(raw + '\n' for raw, _ in failed))
+            f.flush()
+            os.fsync(f.fileno())
+        self.ack(failed)
+
+
+_queues = {}
+
+
+def enabled():
+    from main import app
+
+    return bool(app.config.get('REPLY_QUEUE'))
+
+
+def get_queue():
+    """ The queue REPLY_QUEUE names """
+    from main import app
+
+    kind = app.config.get('REPLY_QUEUE')
+    queue = _queues.get(kind)
+    if queue is None:
+        if kind == 'redis':
+            queue = RedisQueue(app.session_interface.redis)
+        elif kind == 'journal':
+            queue = JournalQueue(app.config.get('REPLY_JOURNAL',
+                                                'replies.journal'))
+        else:
+            raise ValueError('Unknown REPLY_QUEUE ' + repr(kind))
+        _queues[kind] = queue
+    return queue
+
+
+_wakeup = threading.Event()
+
+
+def submit(thread_name, subforum, entry):
+    """
+    Queue a reply to a thread. It's durable once this returns, and
+    gets its number and title when it's flushed.
+    """
+    get_queue().push({'id': uuid.uuid4().hex,
+                      'thread': thread_name,
+                      'subforum': subforum,
+                      'entry': entry})
+    _wakeup.set()
+
+
+def _stored(thread_name, subforum, count):
+    """ (author, published) of the last count posts of a thread """
+    threads = store.get_store()
+    info = threads.info(thread_name, subforum)
+    if not info or not count:
+        return set()
+    return set((p.get('author'), p.get('published')) for p in
+               threads.posts(thread_name, subforum, -count, None))
+
+
+def _unapplied(thread_name, subforum, entries):
+    """ The entries that aren't in the thread yet """
+    stored = _stored(thread_name, subforum, len(entries))
+    return [e for e in entries
+            if (e.get('author'), e.get('published')) not in stored]
+
+
+def pending(thread_name, subforum='/'):
+    """ Queued replies to a thread that aren't stored yet, oldest first """
+    entries = [r['entry'] for r in
+               get_queue().thread_records(thread_name, subforum)]
+    if not entries:
+        return []
+    return [postlog.Post(e) for e in _unapplied(thread_name, subforum,
+                                                 entries)]
+
+
+# When each raw record that failed to flush first failed
+_failing = {}
+
+
+def flush(limit=FLUSH_BATCH):
+    """
+    Apply up to limit queued replies to their threads, and return how
+    many were taken off the queue. Needs an app context.
+    """
+    from werkzeug.exceptions import NotFound
+    from main import app
+    import forum
+
+    with locks.lock('replyqueue.flush'):
+        queue = get_queue()
+        records = queue.peek(limit)
+        if not records:
+            return 0
+
+        # Replies to one thread keep their order, and go in one write
+        batches = collections.OrderedDict()
+        for raw, record in records:
+            key = (record['thread'], record['subforum'])
+            batches.setdefault(key, []).append((raw, record))
+
+        done = []
+        failed = []
+        for (thread_name, subforum), batch in batches.items():
+            try:
+                entries = _unapplied(thread_name, subforum,
+                                     [record['entry'] for _, record in batch])
+                if entries:
+                    forum.commit_replies((thread_name, subforum), entries)
+            except NotFound:
+                sys.stderr.write('Dropping {} replies to missing thread '
+                                 '{}{}\n'.format(len(batch), subforum,
+                                                 thread_name))
+            except Exception as e:
+                # The other threads' replies go on
+                sys.stderr.write('Flushing {} replies to {}{} failed: '
+                                 '{!r}\n'.format(len(batch), subforum,
+                                                 thread_name, e))
+                failed.extend(batch)
+                continue
+            done.extend(batch)
+
+        if done:
+            queue.ack(done)
+
+        # Only what's failing now is remembered
+        now = time.time()
+        since = dict((raw, _failing.get(raw, now)) for raw, _ in failed)
+        _failing.clear()
+        _failing.update(since)
+        dead = [(raw, record) for raw, record in failed
+                if now - since[raw] >= app.config.get('REPLY_DEAD_AFTER', 300)]
+        if dead:
+            sys.stderr.write('Parking {} replies that failed for too '
+                             'long\n'.format(len(dead)))
+            queue.park(dead)
+            for raw, _ in dead:
+                del _failing[raw]
+        return len(done) + len(dead)
+
+
+def run_flusher(app, interval=None):
+    """ Flush queued replies as they come, forever """
+    if interval is None:
+        interval = app.config.get('REPLY_FLUSH_INTERVAL', 0.5)
+
+    while True:
+        _wakeup.wait(interval)
+        _wakeup.clear()
+        try:
+            with app.app_context():
+                while flush():
+                    pass
+        except Exception as e:
+            # The replies stay queued, try again next round
+            sys.stderr.write('Flushing replies failed: {!r}\n'.format(e))
+            time.sleep(interval)
+
+
+_flusher = None
+
+
+def start_flusher(app):
+    """ Run the flusher in a thread of this process, once """
+    global _flusher
+
+    if _flusher is None:
+        _flusher = threading.Thread(target=run_flusher, args=(app,),
+                                    name='reply-flusher')
+        _flusher.daemon = True
+        _flusher.start()
+
+
+if __name__ == '__main__':
+    # python replyqueue.py
+    # Run the flusher on its own, with REPLY_FLUSHER_THREAD = False
+    from main import app
+
+    run_flusher(app)
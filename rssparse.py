@@ -0,0 +1,322 @@
+"""
+rssparse.py
+
+A parser for the thread feeds the forum writes itself, in place of
+feedparser on the hot path. feedparser reads any feed: it builds
+FeedParserDict trees, parses dates and sanitizes every entry up front.
+Our feeds all come out of templates/rss_template.rss, so this just
+scans the memory-mapped file for that template's fixed markup. Items
+are found without being parsed, and only the posts asked for are.
+
+Entries are postrecord.Posts whose title and description stay in the
+mapped file until they're read. Descriptions come back as they were
+written, not sanitized: Post sanitizes its summary when it's shown, as
+it does for post logs.
+
+    python rssparse.py [static_dir]
+
+checks every thread feed against feedparser's reading of it, and a
+feed with a post written to look like the end of its item.
+"""
+import os
+import sys
+import mmap
+
+from xml.sax.saxutils import unescape
+
+import util
+
+from postrecord import Post, TextSlice
+
+ITEM = '<item>'
+ITEM_END = '</item>'
+DESCRIPTION = '<description>\n'
+# The template puts the description on lines of its own, and the
+# address right after it
+DESCRIPTION_END = '\n</description>\n<bit:btcaddress>'
+# Descriptions are html, kept in a CDATA section so feed readers get
+# them whole. Feeds written before that have them raw.
+CDATA = '<![CDATA['
+CDATA_END = ']]>'
+CDATA_SPLIT = ']]]]><![CDATA[>'
+
+# A post's text closing its description and making up an item of its
+# own, which has to read back as the text of one post
+FORGED = ('x ]]> y' + DESCRIPTION_END + '1Forged</bit:btcaddress>\n\n'
+          '</item>\n<item>\n\n<title>RE [3]: forged</title>\n\n'
+          '<link>http://localhost/forged#3</link>\n<author>forger</author>\n'
+          '<pubDate>2013-08-27 05:51:08</pubDate>\n<description>\n'
+          'forged' + DESCRIPTION_END[1:])
+
+
+class ParseError(Exception):
+    pass
+
+
+class Feed(object):
+    """ A parsed thread feed: .feed title and link, .entries newest first """
+
+    __slots__ = ('feed', 'entries')
+
+    def __init__(self, feed, entries):
+        self.feed = feed
+        self.entries = entries
+
+
+def _map(path):
+    """ The contents of a file, memory-mapped, empty if there's no file """
+    if not os.path.exists(path):
+        return ''
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return ''
+        # Stays valid after a writer renames a new file over this one
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _span(data, tag, pos, end):
+    """ Where the text of the first <tag> between pos and end is """
+    start = data.find('<' + tag + '>', pos, end)
+    if start < 0:
+        raise ParseError('No <{}> at {}'.format(tag, pos))
+    start += len(tag) + 2
+    stop = data.find('</' + tag + '>', start, end)
+    if stop < 0:
+        raise ParseError('Unclosed <{}> at {}'.format(tag, start))
+    return start, stop
+
+
+def _element(data, tag, pos, end):
+    """ Text of the first <tag> between pos and end, and where it ends """
+    start, stop = _span(data, tag, pos, end)
+    return data[start:stop], stop + len(tag) + 3
+
+
+def _text(raw):
+    text = unescape(raw.strip())
+    try:
+        # Plain str where it's ascii, a quarter of the size of unicode
+        text.decode('ascii')
+        return text
+    except UnicodeDecodeError:
+        return text.decode('utf-8')
+
+
+def _name(raw):
+    """ _text for authors and addresses, which repeat through a thread """
+    text = _text(raw)
+    return intern(text) if type(text) is str else text
+
+
+def escape_cdata(text):
+    """ Text to put in a CDATA section: any ]]> in it is split up """
+    return (text or '').replace(CDATA_END, CDATA_SPLIT)
+
+
+def _description_span(data, pos, end):
+    """
+    Where the text of the first description between pos and end is.
+    Descriptions are anybody's text, so one in a CDATA section ends
+    where the section does, whatever the text holds.
+    """
+    start = data.find(DESCRIPTION, pos, end)
+    if start < 0:
+        raise ParseError('No <description> at {}'.format(pos))
+    start += len(DESCRIPTION)
+    if data[start:start + len(CDATA)] != CDATA:
+        # Written raw, before CDATA, with nothing to skip. An empty one
+        # shares its newline with the end
+        stop = data.find(DESCRIPTION_END, start - 1, end)
+        if stop < 0:
+            raise ParseError('Unterminated description at {}'.format(start))
+        return start, max(start, stop)
+
+    stop = start + len(CDATA)
+    while True:
+        stop = data.find(CDATA_END, stop, end)
+        if stop < 0:
+            raise ParseError('Unterminated CDATA at {}'.format(start))
+        stop += len(CDATA_END)
+        # A ]]> of the text is split across two sections
+        if data[stop:stop + len(CDATA)] != CDATA:
+            break
+    if data[stop:stop + len(DESCRIPTION_END)] != DESCRIPTION_END:
+        raise ParseError('Unterminated description at {}'.format(start))
+    return start, stop
+
+
+def _description(raw):
+    if raw.startswith(CDATA) and raw.endswith(CDATA_END):
+        raw = raw[len(CDATA):-len(CDATA_END)].replace(CDATA_SPLIT,
+                                                        CDATA_END)
+    return raw.decode('utf-8')
+
+
+class FeedFile(object):
+    """ A thread feed on disk, its items parsed only when asked for """
+
+    def __init__(self, path):
+        self.data = _map(path)
+        self.items = self._find_items()
+
+        header = self.data[:self.items[0][0]] if self.items else self.data
+        self.feed = {}
+        if header:
+            for tag in ('title', 'link'):
+                text, _ = _element(header, tag, 0, len(header))
+                self.feed[tag] = _text(text)
+
+    def _find_items(self):
+        """ (start, end) of every item, in file order, newest post first """
+        data = self.data
+        items = []
+        pos = data.find(ITEM)
+        while pos >= 0:
+            # Skip over the description, it's anybody's text
+            _, description_end = _description_span(data, pos, len(data))
+            end = data.find(ITEM_END, description_end)
+            if end < 0:
+                raise ParseError('Unterminated item at {}'.format(pos))
+            end += len(ITEM_END)
+            items.append((pos, end))
+            pos = data.find(ITEM, end)
+        return items
+
+    def __len__(self):
+        return len(self.items)
+
+    def entry(self, i):
+        """ Item i of the file, 0 being the newest post """
+        data = self.data
+        start, end = self.items[i]
+        title_start, title_stop = _span(data, 'title', start, end)
+        link, pos = _element(data, 'link', title_stop, end)
+        author, pos = _element(data, 'author', pos, end)
+        published, pos = _element(data, 'pubDate', pos, end)
+
+        description, description_end = _description_span(data, pos, end)
+        address, _ = _element(data, 'bit:btcaddress', description_end, end)
+
+        post = Post(n=len(self.items) - i,
+                    link=_text(link),
+                    author=_name(author),
+                    published=_text(published),
+                    bit_btcaddress=_name(address))
+        post.title = TextSlice(data, title_start, title_stop, _text)
+        post.description = TextSlice(data, description, description_end,
+                                     _description)
+        return post
+
+    def posts(self, start=0, stop=None):
+        """
+        (n, entry) of posts start to stop (0 is the OP), oldest first,
+        like slicing the thread. Only those items are parsed.
+        """
+        total = len(self.items)
+        start, stop, _ = slice(start, stop).indices(total)
+        for i in range(start, stop):
+            # Items are newest first, post i is counted from the back
+            yield i + 1, self.entry(total - 1 - i)
+
+
+def parse(path):
+    """ The whole feed at path, like feedparser.parse for our own feeds """
+    feed_file = FeedFile(path)
+    return Feed(feed_file.feed,
+                [feed_file.entry(i) for i in range(len(feed_file))])
+
+
+def check(path):
+    """
+    Where our reading of a feed differs from feedparser's, as a list
+    of messages. Descriptions are compared sanitized, as they're shown.
+    """
+    import feedparser
+
+    theirs = feedparser.parse(path)
+    try:
+        ours = parse(path)
+    except ParseError as e:
+        return ['parse error: {}'.format(e)]
+
+    problems = []
+    for key in ('title', 'link'):
+        if ours.feed.get(key, '') != theirs.feed.get(key, ''):
+            problems.append('feed {}: {!r} != {!r}'.format(
+                key, ours.feed.get(key, ''), theirs.feed.get(key, '')))
+    if len(ours.entries) != len(theirs.entries):
+        problems.append('{} entries, feedparser has {}'.format(
+            len(ours.entries), len(theirs.entries)))
+
+    for i, (entry, expected) in enumerate(zip(ours.entries, theirs.entries)):
+        fields = [(key, entry[key], expected.get(key, '')) for key in
+                  ('title', 'link', 'author', 'published', 'bit_btcaddress')]
+        fields.append(('summary', util.sanitize_html(entry['description']),
+                       expected.get('summary', '')))
+        for key, value, expected_value in fields:
+            if value.strip() != expected_value.strip():
+                problems.append('entry {} {}: {!r} != {!r}'.format(
+                    i, key, value, expected_value))
+    return problems
+
+
+def check_all(current_subforum='static'):
+    """ check() every thread feed in a subforum and below, return the failures """
+    failures = 0
+    for name in util.sorted_ls(current_subforum):
+        if name[-4:] != '.rss':
+            continue
+        path = os.path.join(current_subforum, name)
+        problems = check(path)
+        if problems:
+            failures += 1
+            print path
+            for problem in problems:
+                print '    ' + problem
+    for name in util.find_subforums(current_subforum):
+        failures += check_all(os.path.join(current_subforum, name))
+    return failures
+
+
+def check_forged():
+    """ check() a feed holding a reply of FORGED, as the forum writes it """
+    import tempfile
+    from flask import render_template
+    from main import app
+
+    posts = [{'title': 'RE [2]: Forged', 'author': 'alice',
+              'link': 'http://localhost/forged#2',
+              'published': '2013-08-27 05:51:08', 'description': FORGED,
+              'bit_btcaddress': '1Alice'},
+             {'title': 'Forged', 'author': 'alice',
+              'link': 'http://localhost/forged#1',
+              'published': '2013-08-27 05:50:00', 'description': 'op',
+              'bit_btcaddress': '1Alice'}]
+    with app.test_request_context():
+        text = render_template('rss_template.rss', posts=posts,
+                               title='Forged', link='http://localhost/forged')
+
+    fd, path = tempfile.mkstemp(suffix='.rss')
+    try:
+        os.write(fd, text.encode('utf-8'))
+        os.close(fd)
+        problems = check(path)
+        if not problems and parse(path).entries[0]['description'] != FORGED:
+            problems.append('forged reply read back as {!r}'.format(
+                parse(path).entries[0]['description']))
+        return problems
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    # python rssparse.py [static_dir]
+    failures = check_all(sys.argv[1] if len(sys.argv) > 1 else 'static')
+    problems = check_forged()
+    if problems:
+        failures += 1
+        print 'forged reply'
+        for problem in problems:
+            print '    ' + problem
+    print '{} feeds differ from feedparser'.format(failures)
+    sys.exit(1 if failures else 0)
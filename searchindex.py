@@ -0,0 +1,301 @@
+"""
+searchindex.py
+
+Full text search over posts. Every post is a document, its title and
+text cut into lowercase word terms; the postings (term, document,
+count) live in an SQLite database at SEARCH_DB, with the number of
+documents holding each term, so a query only reads the postings of
+its own terms. Results are ranked with BM25, words of a thread's title
+counting TITLE_WEIGHT times in its first post, scored and sorted by
+SQLite so only the page asked for comes back to Python.
+
+new_thread and commit_replies add their posts as they write them. If
+that fails, e.g. on a database locked for too long, the posts are kept
+in the process and tried again with the next ones.
+
+To index everything already written, e.g. after turning search on:
+
+    python searchindex.py [static_dir]
+
+which empties the index and streams every post of the store back into
+it, committing every REBUILD_BATCH posts so the web nodes can go on
+adding theirs in between. Searches see the posts indexed so far.
+"""
+import os
+import re
+import sys
+import math
+import sqlite3
+import threading
+
+import util
+import store
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    id INTEGER PRIMARY KEY,
+    subforum TEXT NOT NULL,
+    thread TEXT NOT NULL,
+    n INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    author TEXT NOT NULL,
+    excerpt TEXT NOT NULL,
+    length INTEGER NOT NULL,
+    UNIQUE (subforum, thread, n)
+);
+CREATE TABLE IF NOT EXISTS terms (
+    id INTEGER PRIMARY KEY,
+    term TEXT NOT NULL UNIQUE,
+    df INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS postings (
+    term_id INTEGER NOT NULL,
+    doc_id INTEGER NOT NULL,
+    tf INTEGER NOT NULL,
+    PRIMARY KEY (term_id, doc_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS totals (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    docs INTEGER NOT NULL,
+    length INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO totals VALUES (0, 0, 0);
+"""
+
+TITLE_WEIGHT = 3
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+EXCERPT_LENGTH = 200
+
+# Posts indexed by rebuild() per transaction
+REBUILD_BATCH = 500
+# Posts kept to index again after a failure, the oldest dropped past it
+MAX_RETRY_POSTS = 10000
+
+TAG = re.compile(r'<[^>]*>')
+WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """ Lowercase words of a post's text, markup dropped """
+    return [w for w in WORD.findall(TAG.sub(' ', text or '').lower())
+            if len(w) > 1]
+
+
+def _plain(text):
+    return ' '.join(TAG.sub(' ', text or '').split())
+
+
+def _counts(post):
+    """ {term: weighted count} and the document length of a post """
+    counts = {}
+    if post['n'] == 1:
+        # Replies' titles are just 'RE [n]: ' and the thread's title
+        for term in tokenize(post.get('title')):
+            counts[term] = counts.get(term, 0) + TITLE_WEIGHT
+    for term in tokenize(post.get('description')):
+        counts[term] = counts.get(term, 0) + 1
+    return counts, sum(counts.values())
+
+
+class SearchIndex(object):
+    """ The inverted index in one SQLite file """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def db(self):
+        """ This thread's connection, opened on first use """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _add(self, db, subforum, thread_name, post):
+        counts, length = _counts(post)
+        cursor = db.execute(
+            'INSERT OR IGNORE INTO docs (subforum, thread, n, title, author, '
+            'excerpt, length) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (subforum, thread_name, post['n'], post.get('title', ''),
+             post.get('author', ''),
+             _plain(post.get('description'))[:EXCERPT_LENGTH], length))
+        if not cursor.rowcount:
+            # Already indexed
+            return
+        doc_id = cursor.lastrowid
+
+        db.executemany('INSERT OR IGNORE INTO terms (term, df) VALUES (?, 0)',
+                       ((term,) for term in counts))
+        db.executemany('UPDATE terms SET df = df + 1 WHERE term = ?',
+                       ((term,) for term in counts))
+        db.executemany(
+            'INSERT INTO postings (term_id, doc_id, tf) '
+            'SELECT id, ?, ? FROM terms WHERE term = ?',
+            ((doc_id, tf, term) for term, tf in counts.items()))
+        db.execute('UPDATE totals SET docs = docs + 1, length = length + ?',
+                   (length,))
+
+    def add_posts(self, subforum, thread_name, posts):
+        """ Index new posts of a thread, each with its number in post['n'] """
+        self.add_batches([(subforum, thread_name, posts)])
+
+    def add_batches(self, batches):
+        """ add_posts for each (subforum, thread, posts), in one transaction """
+        db = self.db()
+        with db:
+            for subforum, thread_name, posts in batches:
+                for post in posts:
+                    self._add(db, subforum, thread_name, post)
+
+    def search(self, query, offset=0, limit=20):
+        """
+        Posts matching any word of the query, best first: a list of
+        result dicts from offset on, and how many results there are
+        """
+        terms = sorted(set(tokenize(query)))
+        if not terms:
+            return [], 0
+
+        db = self.db()
+        num_docs, total_length = db.execute(
+            'SELECT docs, length FROM totals').fetchone()
+        if not num_docs:
+            return [], 0
+        avg_length = float(total_length) / num_docs
+
+        weights = []
+        for term in terms:
+            row = db.execute('SELECT id, df FROM terms WHERE term = ?',
+                             (term,)).fetchone()
+            if row is None or not row[1]:
+                continue
+            term_id, df = row
+            weights.append((term_id,
+                            math.log(1 + (num_docs - df + 0.5) / (df + 0.5))))
+        if not weights:
+            return [], 0
+
+        term_ids = [term_id for term_id, _ in weights]
+        count = db.execute(
+            'SELECT COUNT(DISTINCT doc_id) FROM postings WHERE term_id IN '
+            '({})'.format(', '.join('?' * len(term_ids))),
+            term_ids).fetchone()[0]
+
+        # The query's terms with their idf, as a table to join postings to
+        query_terms = ' UNION ALL '.join(['SELECT ? AS term_id, ? AS idf'] *
+                                         len(weights))
+        rows = db.execute(
+            'SELECT subforum, thread, n, title, author, excerpt, '
+            'SUM(idf * tf * ? / (tf + ? * (1 - ? + ? * length / ?))) '
+            'AS score FROM ({}) AS query_terms '
+            'JOIN postings USING (term_id) '
+            'JOIN docs ON docs.id = doc_id '
+            'GROUP BY doc_id ORDER BY score DESC, doc_id '
+            'LIMIT ? OFFSET ?'.format(query_terms),
+            [K1 + 1, K1, B, B, avg_length] +
+            [value for weight in weights for value in weight] +
+            [limit, offset])
+        results = [dict(zip(('subforum', 'thread', 'n', 'title', 'author',
+                             'excerpt', 'score'), row)) for row in rows]
+        return results, count
+
+    def stats(self):
+        num_docs, length = self.db().execute(
+            'SELECT docs, length FROM totals').fetchone()
+        num_terms = self.db().execute('SELECT COUNT(*) FROM terms').fetchone()
+        return {'docs': num_docs, 'terms': num_terms[0], 'length': length}
+
+
+_indexes = {}
+
+
+def get_index():
+    """ The index at SEARCH_DB, or None if search is off """
+    from main import app
+
+    path = app.config.get('SEARCH_DB')
+    if not path:
+        return None
+    if path not in _indexes:
+        _indexes[path] = SearchIndex(path)
+    return _indexes[path]
+
+
+_failed = []
+_failed_lock = threading.Lock()
+
+
+def add_posts(subforum, thread_name, posts):
+    """
+    Index posts just written to a thread. The posts are safely stored
+    already, so a failure here is reported and the posts kept to try
+    again with the next ones, up to MAX_RETRY_POSTS of them; the rest
+    are left for a rebuild.
+    """
+    index = get_index()
+    if index is None:
+        return
+    with _failed_lock:
+        batches = _failed[:]
+        del _failed[:]
+    batches.append((subforum, thread_name, list(posts)))
+    try:
+        index.add_batches(batches)
+    except sqlite3.Error as e:
+        with _failed_lock:
+            _failed[:0] = batches
+            kept = sum(len(posts) for _, _, posts in _failed)
+            while kept > MAX_RETRY_POSTS:
+                kept -= len(_failed.pop(0)[2])
+        sys.stderr.write('Indexing posts of {}{} failed, {} posts to try '
+                         'again: {!r}\n'.format(subforum, thread_name, kept,
+                                                 e))
+
+
+def _index_subforum(index, db, current_subforum, added=0):
+    """ Index a subforum and below, and return the count of posts added """
+    threads = store.get_store()
+    subforum = os.path.normpath(current_subforum)[len('static'):] or '/'
+    for thread_name in threads.threads(subforum):
+        for post in threads.posts(thread_name, subforum):
+            index._add(db, subforum, thread_name, post)
+            added += 1
+            if not added % REBUILD_BATCH:
+                db.commit()
+        print 'Indexed ' + os.path.join(current_subforum, thread_name)
+
+    for name in util.find_subforums(current_subforum):
+        added = _index_subforum(index, db, os.path.join(current_subforum,
+                                                        name), added)
+    return added
+
+
+def rebuild(current_subforum='static'):
+    """ Index every post of the store from scratch """
+    from main import app
+
+    path = app.config.get('SEARCH_DB') or 'search.db'
+    index = SearchIndex(path)
+    db = index.db()
+    with db:
+        db.execute('DELETE FROM postings')
+        db.execute('DELETE FROM terms')
+        db.execute('DELETE FROM docs')
+        db.execute('UPDATE totals SET docs = 0, length = 0')
+    # Posts written meanwhile are either read here or added by their
+    # writer, and adding a post twice does nothing
+    with db:
+        _index_subforum(index, db, current_subforum)
+    return index.stats()
+
+
+if __name__ == '__main__':
+    # python searchindex.py [static_dir]
+    print rebuild(sys.argv[1] if len(sys.argv) > 1 else 'static')
@@ -0,0 +1,362 @@
+"""
+segmentstore.py
+
+The 'segments' THREAD_STORAGE backend, for very long threads. A thread
+is a directory static/<subforum>/<thread>.segments of segment files,
+each up to SEGMENT_SIZE posts as JSON lines and named after the number
+of its first post. Only the last segment is ever written to: replies
+are appended to it, and once it's full it's sealed, rewritten as
+<first>.json.gz and never changed again. So
+
+- a page reads only the segments holding its posts,
+- sealed segments are parsed once per process and stay cached
+  (threadcache), however long the thread grows,
+- a reply doesn't touch any older post, and
+- sealed segments are served as they are, gzipped and with a
+  long-lived Cache-Control header (see main.py).
+
+Threads still only in rss are read from the feed and split into
+segments on their first reply. The public .rss feed is exported from
+the segments when it falls behind, like for post logs.
+"""
+import os
+import json
+import gzip
+import bisect
+import shutil
+import tempfile
+
+from flask import render_template
+
+import config
+import util
+import store
+import postlog
+import postrecord
+import postrender
+import threadcache
+
+SEGMENT_SIZE = getattr(config, 'SEGMENT_SIZE', 100)
+
+TAIL = '.log'
+SEALED = '.json.gz'
+
+
+def segments_path(thread_name, subforum='/'):
+    """ Directory holding a thread's segments """
+    return os.path.normpath('static' + subforum + '/' + thread_name +
+                            '.segments')
+
+
+def segment_name(first, sealed):
+    return '{:08d}{}'.format(first, SEALED if sealed else TAIL)
+
+
+def _read_lines(f):
+    posts = []
+    for line in f:
+        if not line.endswith('\n'):
+            # Torn by a crash mid-append, never acknowledged
+            break
+        posts.append(postlog.Post(json.loads(line)))
+    return posts
+
+
+def _read_segment(path):
+    if path.endswith(SEALED):
+        with gzip.open(path, 'rb') as f:
+            return _read_lines(f)
+    with open(path, 'rb') as f:
+        return _read_lines(f)
+
+
+def _write_segment(path, data):
+    """ Write out a whole segment file, gzipped if it's a sealed one """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path),
+                               prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if path.endswith(SEALED):
+                # No name or time in the header, the same posts always
+                # make the same file
+                with gzip.GzipFile(filename='', mode='wb', fileobj=f,
+                                   mtime=0) as gz:
+                    gz.write(data)
+            else:
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+def _lines(posts):
+    return ''.join(json.dumps(postrecord.as_dict(post)) + '\n'
+                   for post in posts)
+
+
+class Segments(object):
+    """ The segment files of one thread, as they are on disk now """
+
+    def __init__(self, thread_name, subforum='/'):
+        self.path = segments_path(thread_name, subforum)
+        sealed = {}
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            names = []
+        for name in names:
+            first = name.split('.', 1)[0]
+            # Skips temporary files, they start with a dot
+            if not first.isdigit():
+                continue
+            # A sealed copy wins over a tail its writer didn't get to
+            # remove before dying
+            sealed[int(first)] = sealed.get(int(first)) or \
+                name.endswith(SEALED)
+        # Number of the first post of each segment, in order
+        self.firsts = sorted(sealed)
+        self.sealed = [sealed[first] for first in self.firsts]
+
+    def file(self, i):
+        return os.path.join(self.path,
+                            segment_name(self.firsts[i], self.sealed[i]))
+
+    def load(self, i):
+        """ The posts of segment i """
+        # Sealed segments never change, so once parsed they're hits
+        # for good; the tail is reparsed when it grows
+        return threadcache.load(self.file(i), _read_segment)
+
+    def __len__(self):
+        if not self.firsts:
+            return 0
+        return self.firsts[-1] - 1 + len(self.load(-1))
+
+    def mtime(self):
+        """ When the last segment was written """
+        return os.stat(self.file(-1)).st_mtime
+
+    def iter(self, start, stop):
+        """ Posts start to stop (0 is the OP), reading only their segments """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        if start >= stop:
+            return
+        i = bisect.bisect_right(self.firsts, start + 1) - 1
+        while i < len(self.firsts) and self.firsts[i] - 1 < stop:
+            offset = self.firsts[i] - 1
+            for post in self.load(i)[max(start - offset, 0):stop - offset]:
+                yield post
+            i += 1
+
+
+def _append(path, posts):
+    with open(path, 'a+b') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell():
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != '\n':
+                # Drop what's left of a post we crashed while writing
+                f.seek(0)
+                f.truncate(f.read().rfind('\n') + 1)
+        f.write(_lines(posts))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _seal(directory, first):
+    """ Replace a full tail segment by its final, compressed copy """
+    tail = os.path.join(directory, segment_name(first, False))
+    with open(tail, 'rb') as f:
+        data = f.read()
+    _write_segment(os.path.join(directory, segment_name(first, True)), data)
+    # Readers take the sealed copy from here on
+    os.unlink(tail)
+
+
+def append_posts(thread_name, subforum, entries, size=None):
+    """
+    Append posts to the tail segment of a thread, sealing it and
+    starting the next whenever it fills up. The caller holds the
+    thread lock and sets entry['n'].
+    """
+    size = size or SEGMENT_SIZE
+    segments = Segments(thread_name, subforum)
+    if not os.path.isdir(segments.path):
+        os.makedirs(segments.path)
+
+    # First post of the segment being written to, None to start one
+    first = None
+    if segments.firsts and not segments.sealed[-1]:
+        first = segments.firsts[-1]
+
+    i = 0
+    while i < len(entries):
+        if first is None:
+            first = entries[i]['n']
+        room = first + size - entries[i]['n']
+        if room <= 0:
+            # Full already, e.g. after SEGMENT_SIZE went down
+            _seal(segments.path, first)
+            first = None
+            continue
+        batch = entries[i:i + room]
+        i += len(batch)
+        _append(os.path.join(segments.path, segment_name(first, False)),
+                batch)
+        if len(batch) == room:
+            _seal(segments.path, first)
+            first = None
+
+
+def write_segments(thread_name, subforum, posts, size=None):
+    """
+    Replace a thread's segments with the given posts, oldest first,
+    written out as they come. The caller holds the thread lock.
+    """
+    size = size or SEGMENT_SIZE
+    path = segments_path(thread_name, subforum)
+    tmp = tempfile.mkdtemp(dir=os.path.dirname(path),
+                           prefix='.' + os.path.basename(path))
+    try:
+        batch = []
+        first = 1
+        for post in posts:
+            batch.append(post)
+            if len(batch) == size:
+                _write_segment(os.path.join(tmp, segment_name(first, True)),
+                               _lines(batch))
+                first += len(batch)
+                batch = []
+        if batch:
+            _write_segment(os.path.join(tmp, segment_name(first, False)),
+                           _lines(batch))
+        os.chmod(tmp, 0o755)
+
+        if os.path.exists(path):
+            # Move the old segments aside to swap the new ones in
+            old = tempfile.mkdtemp(dir=os.path.dirname(path),
+                                   prefix='.' + os.path.basename(path))
+            os.rename(path, os.path.join(old, 'segments'))
+            os.rename(tmp, path)
+            shutil.rmtree(old)
+        else:
+            os.rename(tmp, path)
+    except:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+
+class SegmentStore(store.RssStore):
+    """
+    Threads as segment directories, with the .rss feed exported from
+    them. Threads still only in rss are read from the feed.
+    """
+
+    def _segmented(self, thread_name, subforum):
+        return os.path.isdir(segments_path(thread_name, subforum))
+
+    def exists(self, thread_name, subforum='/'):
+        return (self._segmented(thread_name, subforum) or
+                store.RssStore.exists(self, thread_name, subforum))
+
+    def info(self, thread_name, subforum='/'):
+        if not self._segmented(thread_name, subforum):
+            return store.RssStore.info(self, thread_name, subforum)
+        segments = Segments(thread_name, subforum)
+        num_posts = len(segments)
+        if not num_posts:
+            return None
+        op = segments.load(0)[0]
+        return op['title'], op.get('feed_link', ''), num_posts
+
+    def mtime(self, thread_name, subforum='/'):
+        if not self._segmented(thread_name, subforum):
+            return store.RssStore.mtime(self, thread_name, subforum)
+        return Segments(thread_name, subforum).mtime()
+
+    def posts(self, thread_name, subforum='/', start=0, stop=None):
+        if not self._segmented(thread_name, subforum):
+            return store.RssStore.posts(self, thread_name, subforum,
+                                        start, stop)
+        return Segments(thread_name, subforum).iter(start, stop)
+
+    def create(self, thread_name, subforum, entry, link):
+        # Readers of the feed shouldn't have to wait for an export
+        util.render_thread_rss(thread_name, subforum,
+                               [entry], entry['title'], link=link)
+        append_posts(thread_name, subforum,
+                     [dict(entry, n=1, feed_link=link)])
+
+    def append(self, thread_name, subforum, entries):
+        if not self._segmented(thread_name, subforum):
+            # Thread predates the segments, convert it once
+            write_segments(thread_name, subforum,
+                           store.RssStore.posts(self, thread_name, subforum))
+        append_posts(thread_name, subforum, entries)
+
+    def threads(self, subforum='/'):
+        names = []
+        for name in util.sorted_ls('static' + subforum):
+            if name[-4:] == '.rss':
+                names.append(name[:-4])
+            elif name[-9:] == '.segments':
+                names.append(name[:-9])
+        # Most threads have both
+        seen = set()
+        return [name for name in names
+                if not (name in seen or seen.add(name))]
+
+    def rerender(self, thread_name, subforum='/'):
+        if not self._segmented(thread_name, subforum):
+            return store.RssStore.rerender(self, thread_name, subforum)
+        segments = Segments(thread_name, subforum)
+        count = 0
+        for i in range(len(segments.firsts)):
+            # Cached posts are shared, change copies
+            posts = [postlog.Post(post) for post in segments.load(i)]
+            stale = [post for post in posts if post.get('renderer') !=
+                     postrender.RENDERER_VERSION]
+            for post in stale:
+                postrender.stamp(post)
+            if stale:
+                _write_segment(segments.file(i), _lines(posts))
+                count += len(stale)
+        return count
+
+    def feed_is_stale(self, thread_name, subforum='/'):
+        if not self._segmented(thread_name, subforum):
+            return False
+        return postlog.feed_behind(postlog.rss_path(thread_name, subforum),
+                                   self.mtime(thread_name, subforum))
+
+    def export_rss(self, thread_name, subforum='/'):
+        # Stamped with the thread's time as it was before reading it,
+        # so a reply landing mid-export leaves the feed marked stale
+        mtime = self.mtime(thread_name, subforum)
+        posts = list(self.posts(thread_name, subforum))
+        if not posts:
+            return
+        text = render_template('rss_template.rss',
+                               posts=reversed(posts),
+                               title=posts[0]['title'],
+                               link=posts[0].get('feed_link', ''))
+        rss = postlog.rss_path(thread_name, subforum)
+        util.atomic_write(rss, text, encoding='utf-8')
+        os.utime(rss, (mtime, mtime))
+
+    def refresh_feeds(self, current_subforum='static'):
+        store.ThreadStore.refresh_feeds(self, current_subforum)
+
+    def touch(self, thread_name, subforum, mtime):
+        if not self._segmented(thread_name, subforum):
+            return store.RssStore.touch(self, thread_name, subforum, mtime)
+        os.utime(Segments(thread_name, subforum).file(-1), (mtime, mtime))
+
+    def import_thread(self, thread_name, subforum, posts, mtime=None):
+        write_segments(thread_name, subforum, posts)
+        if mtime:
+            self.touch(thread_name, subforum, mtime)
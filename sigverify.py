@@ -0,0 +1,97 @@
+"""
+sigverify.py
+
+Checks the signatures users log in and register with. SIG_VERIFIER
+picks how:
+
+    'local'  - in this process, with cryptoapi's generate_keypair, so a
+               login costs no request to another server
+    'remote' - POSTed to the cryptoapi service at COIN_API /check_sig
+               by coinapi's client, waiting at most SIG_VERIFY_TIMEOUT
+               seconds for it
+
+Either way verify() gives the address that signed, or None for a bad
+signature or if it couldn't be checked.
+"""
+import os
+import sys
+
+import coinapi
+
+CRYPTOAPI_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'cryptoapi')
+
+
+class Verifier(object):
+    """ Checks that signature signs message, by btc_addr if it's given """
+
+    def verify(self, message, signature, btc_addr=None):
+        raise NotImplementedError
+
+
+class LocalVerifier(Verifier):
+    """ Recovers the signing address in process, as cryptoapi does """
+
+    def __init__(self):
+        if CRYPTOAPI_DIR not in sys.path:
+            # generate_keypair and its msqr are modules of cryptoapi.
+            # Appended, so nothing of ours is shadowed by them
+            sys.path.append(CRYPTOAPI_DIR)
+        import generate_keypair
+        self.key_class = generate_keypair.EC_KEY
+
+    def verify(self, message, signature, btc_addr=None):
+        try:
+            return self.key_class.verify_message(btc_addr, signature,
+                                                 message)
+        except Exception as e:
+            # Malformed and wrong signatures alike raise
+            sys.stderr.write('Bad signature: {!r}\n'.format(e))
+            return None
+
+
+class RemoteVerifier(Verifier):
+    """ Asks the cryptoapi service, through a coinapi client """
+
+    def __init__(self, client):
+        self.client = client
+
+    def verify(self, message, signature, btc_addr=None):
+        try:
+            resp = self.client.post('/check_sig',
+                                    {'signature': signature,
+                                     'message': message,
+                                     'btc_addr': btc_addr})
+        except coinapi.CoinApiError as e:
+            sys.stderr.write('Signature check failed: {}\n'.format(e))
+            return None
+        if resp.ok:
+            return resp.text
+        return None
+
+
+_verifiers = {}
+
+
+def get_verifier(kind=None):
+    """ The verifier named kind, by default the one SIG_VERIFIER names """
+    from main import app
+
+    if kind is None:
+        kind = app.config.get('SIG_VERIFIER', 'local')
+
+    verifier = _verifiers.get(kind)
+    if verifier is None:
+        if kind == 'local':
+            verifier = LocalVerifier()
+        elif kind == 'remote':
+            verifier = RemoteVerifier(coinapi.get_client())
+        else:
+            raise ValueError('Unknown SIG_VERIFIER ' + repr(kind))
+        _verifiers[kind] = verifier
+    return verifier
+
+
+def verify(message, signature, btc_addr=None):
+    """ The address that signed message, or None """
+    return get_verifier().verify(message, signature, btc_addr)
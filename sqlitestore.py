@@ -0,0 +1,345 @@
+"""
+sqlitestore.py
+
+The 'sqlite' THREAD_STORAGE backend: every thread and post in one
+SQLite database (SQLITE_PATH in config.py). Posts are keyed by thread
+and post number, so a page is a range scan of the primary key, and
+threads are indexed by subforum and latest activity, so listings and
+their cursors are range scans too. Subforum totals are kept in their
+own table, updated in the same transaction as the post.
+
+The static directory tree still defines the subforums, and public
+.rss feeds are exported to it from the database when they fall behind.
+"""
+import os
+import time
+import sqlite3
+import threading
+
+from flask import render_template
+
+import util
+import store
+import postlog
+import postrender
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS threads (
+    id INTEGER PRIMARY KEY,
+    subforum TEXT NOT NULL,
+    name TEXT NOT NULL,
+    title TEXT NOT NULL,
+    link TEXT NOT NULL,
+    num_posts INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    op_author TEXT NOT NULL,
+    last_author TEXT NOT NULL,
+    last_published TEXT NOT NULL,
+    UNIQUE (subforum, name)
+);
+CREATE INDEX IF NOT EXISTS threads_by_activity
+    ON threads (subforum, mtime DESC, name);
+
+CREATE TABLE IF NOT EXISTS posts (
+    thread_id INTEGER NOT NULL REFERENCES threads (id),
+    n INTEGER NOT NULL,
+    title TEXT,
+    author TEXT,
+    published TEXT,
+    link TEXT,
+    bit_btcaddress TEXT,
+    description TEXT,
+    html TEXT,
+    renderer INTEGER,
+    PRIMARY KEY (thread_id, n)
+);
+
+CREATE TABLE IF NOT EXISTS subforums (
+    path TEXT PRIMARY KEY,
+    num_threads INTEGER NOT NULL,
+    num_posts INTEGER NOT NULL,
+    last_published TEXT NOT NULL,
+    mtime REAL NOT NULL
+);
+"""
+
+POST_FIELDS = ('title', 'author', 'published', 'link', 'bit_btcaddress',
+               'description', 'html', 'renderer')
+
+THREAD_FIELDS = ('name', 'title', 'link', 'num_posts', 'mtime',
+                 'op_author', 'last_author', 'last_published')
+
+
+def _key(subforum):
+    """ Subforums are stored the way threadindex names them, 'static/sub' """
+    return os.path.normpath('static' + subforum)
+
+
+def _post_row(thread_id, entry):
+    return ((thread_id, entry['n']) +
+            tuple(entry.get(field) for field in POST_FIELDS))
+
+
+class SqliteStore(store.ThreadStore):
+    """ Threads, posts and subforum totals in a SQLite database """
+
+    indexes_threads = True
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def db(self):
+        """ This thread's connection, opened on first use """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            # Readers don't wait for writers, or writers for readers
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _thread(self, thread_name, subforum):
+        return self.db().execute(
+            'SELECT * FROM threads WHERE subforum = ? AND name = ?',
+            (_key(subforum), thread_name)).fetchone()
+
+    def _bump(self, db, path, threads, posts, published, mtime):
+        """ Add to a subforum's totals, inside the caller's transaction """
+        db.execute('INSERT OR IGNORE INTO subforums VALUES (?, 0, 0, \'\', 0)',
+                   (path,))
+        db.execute('UPDATE subforums SET num_threads = num_threads + ?, '
+                   'num_posts = num_posts + ?, last_published = ?, mtime = ? '
+                   'WHERE path = ?',
+                   (threads, posts, published, mtime, path))
+
+    def _recount(self, db, path):
+        """ Count a subforum's totals again from its threads """
+        num_threads, num_posts = db.execute(
+            'SELECT COUNT(*), TOTAL(num_posts) FROM threads '
+            'WHERE subforum = ?', (path,)).fetchone()
+        latest = db.execute(
+            'SELECT last_published, mtime FROM threads WHERE subforum = ? '
+            'ORDER BY mtime DESC LIMIT 1', (path,)).fetchone()
+        db.execute('INSERT OR REPLACE INTO subforums VALUES (?, ?, ?, ?, ?)',
+                   (path, num_threads, int(num_posts),
+                    latest[0] if latest else '',
+                    latest[1] if latest else 0))
+
+    def exists(self, thread_name, subforum='/'):
+        return self._thread(thread_name, subforum) is not None
+
+    def info(self, thread_name, subforum='/'):
+        row = self._thread(thread_name, subforum)
+        if row is None:
+            return None
+        return row['title'], row['link'], row['num_posts']
+
+    def mtime(self, thread_name, subforum='/'):
+        return self._thread(thread_name, subforum)['mtime']
+
+    def posts(self, thread_name, subforum='/', start=0, stop=None):
+        row = self._thread(thread_name, subforum)
+        if row is None:
+            return
+        start, stop, _ = slice(start, stop).indices(row['num_posts'])
+        cursor = self.db().execute(
+            'SELECT n, ' + ', '.join(POST_FIELDS) + ' FROM posts '
+            'WHERE thread_id = ? AND n > ? AND n <= ? ORDER BY n',
+            (row['id'], start, stop))
+        for record in cursor:
+            post = postlog.Post((k, record[k]) for k in record.keys()
+                                if record[k] is not None)
+            if post['n'] == 1:
+                post['feed_link'] = row['link']
+            yield post
+
+    def create(self, thread_name, subforum, entry, link):
+        mtime = time.time()
+        db = self.db()
+        with db:
+            thread_id = db.execute(
+                'INSERT INTO threads (subforum, name, title, link, num_posts, '
+                'mtime, op_author, last_author, last_published) '
+                'VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?)',
+                (_key(subforum), thread_name, entry['title'], link, mtime,
+                 entry['author'], entry['author'],
+                 entry['published'])).lastrowid
+            db.execute('INSERT INTO posts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       _post_row(thread_id, dict(entry, n=1)))
+            self._bump(db, _key(subforum), 1, 1, entry['published'], mtime)
+
+    def append(self, thread_name, subforum, entries):
+        mtime = time.time()
+        row = self._thread(thread_name, subforum)
+        last = entries[-1]
+        db = self.db()
+        with db:
+            db.executemany(
+                'INSERT INTO posts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (_post_row(row['id'], entry) for entry in entries))
+            db.execute('UPDATE threads SET num_posts = num_posts + ?, '
+                       'mtime = ?, last_author = ?, last_published = ? '
+                       'WHERE id = ?',
+                       (len(entries), mtime, last['author'],
+                        last['published'], row['id']))
+            self._bump(db, _key(subforum), 0, len(entries),
+                       last['published'], mtime)
+
+    def threads(self, subforum='/'):
+        return [row[0] for row in self.db().execute(
+            'SELECT name FROM threads WHERE subforum = ? ORDER BY mtime',
+            (_key(subforum),))]
+
+    def touch(self, thread_name, subforum, mtime):
+        db = self.db()
+        with db:
+            db.execute('UPDATE threads SET mtime = ? '
+                       'WHERE subforum = ? AND name = ?',
+                       (mtime, _key(subforum), thread_name))
+            self._recount(db, _key(subforum))
+
+    def rerender(self, thread_name, subforum='/'):
+        row = self._thread(thread_name, subforum)
+        if row is None:
+            return 0
+        db = self.db()
+        stale = db.execute(
+            'SELECT n, description FROM posts WHERE thread_id = ? AND '
+            '(renderer IS NULL OR renderer != ?)',
+            (row['id'], postrender.RENDERER_VERSION)).fetchall()
+        with db:
+            db.executemany(
+                'UPDATE posts SET html = ?, renderer = ? '
+                'WHERE thread_id = ? AND n = ?',
+                [(postrender.render(description or ''),
+                  postrender.RENDERER_VERSION, row['id'], n)
+                 for n, description in stale])
+        return len(stale)
+
+    def feed_is_stale(self, thread_name, subforum='/'):
+        rss = postlog.rss_path(thread_name, subforum)
+        row = self._thread(thread_name, subforum)
+        if row is None:
+            return False
+        return postlog.feed_behind(rss, row['mtime'])
+
+    def export_rss(self, thread_name, subforum='/'):
+        row = self._thread(thread_name, subforum)
+        if row is None:
+            return
+        posts = list(self.posts(thread_name, subforum))
+        text = render_template('rss_template.rss',
+                               posts=reversed(posts),
+                               title=row['title'],
+                               link=row['link'])
+
+        rss = postlog.rss_path(thread_name, subforum)
+        util.atomic_write(rss, text, encoding='utf-8')
+        # Stamped with the thread's time, like postlog.export_rss
+        os.utime(rss, (row['mtime'], row['mtime']))
+
+    def refresh_feeds(self, current_subforum='static'):
+        subforum = os.path.normpath(current_subforum)[len('static'):] or '/'
+        for name, mtime in self.db().execute(
+                'SELECT name, mtime FROM threads WHERE subforum = ?',
+                (os.path.normpath(current_subforum),)).fetchall():
+            rss = postlog.rss_path(name, subforum)
+            if postlog.feed_behind(rss, mtime):
+                self.export_rss(name, subforum)
+
+    def import_thread(self, thread_name, subforum, posts, mtime=None):
+        mtime = mtime or time.time()
+        posts = iter(posts)
+        op = next(posts, None)
+        if op is None:
+            return
+
+        db = self.db()
+        path = _key(subforum)
+        with db:
+            old = db.execute('SELECT id FROM threads '
+                             'WHERE subforum = ? AND name = ?',
+                             (path, thread_name)).fetchone()
+            if old:
+                db.execute('DELETE FROM posts WHERE thread_id = ?', (old[0],))
+                db.execute('DELETE FROM threads WHERE id = ?', (old[0],))
+
+            thread_id = db.execute(
+                'INSERT INTO threads (subforum, name, title, link, num_posts, '
+                'mtime, op_author, last_author, last_published) '
+                'VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?)',
+                (path, thread_name, op.get('title', ''),
+                 op.get('feed_link', ''), mtime, op.get('author', ''),
+                 op.get('author', ''), op.get('published', ''))).lastrowid
+
+            # Posts go straight from the source into the insert
+            last = [dict(op, n=1)]
+
+            def rows():
+                yield _post_row(thread_id, last[0])
+                for post in posts:
+                    last[0] = post
+                    yield _post_row(thread_id, post)
+
+            db.executemany(
+                'INSERT INTO posts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                rows())
+            db.execute('UPDATE threads SET num_posts = ?, last_author = ?, '
+                       'last_published = ? WHERE id = ?',
+                       (last[0]['n'], last[0].get('author', ''),
+                        last[0].get('published', ''), thread_id))
+            self._recount(db, path)
+
+    # Listings, in place of threadindex's files
+
+    def _meta(self, row):
+        return dict((field, row[field]) for field in THREAD_FIELDS)
+
+    def thread_meta(self, current_subforum, thread_name):
+        row = self.db().execute(
+            'SELECT * FROM threads WHERE subforum = ? AND name = ?',
+            (os.path.normpath(current_subforum), thread_name)).fetchone()
+        return row and self._meta(row)
+
+    def page(self, current_subforum, after=None, limit=None):
+        """
+        Like ThreadIndex.page: threads following the activity key
+        after, and the key of the page after that (None on the last)
+        """
+        path = os.path.normpath(current_subforum)
+        sql = 'SELECT * FROM threads WHERE subforum = ?'
+        args = [path]
+        if after is not None:
+            mtime, name = -after[0], after[1]
+            sql += ' AND mtime <= ? AND (mtime < ? OR name > ?)'
+            args += [mtime, mtime, name]
+        sql += ' ORDER BY mtime DESC, name'
+        if limit is not None:
+            # One more tells us if there's a next page
+            sql += ' LIMIT ?'
+            args.append(limit + 1)
+
+        rows = self.db().execute(sql, args).fetchall()
+        threads = [self._meta(row) for row in rows[:limit]]
+        cursor = None
+        if limit is not None and len(rows) > limit:
+            cursor = (-threads[-1]['mtime'], threads[-1]['name'])
+        return threads, cursor
+
+    def counters(self, current_subforum):
+        row = self.db().execute('SELECT * FROM subforums WHERE path = ?',
+                                (os.path.normpath(current_subforum),)).fetchone()
+        if row is None:
+            return {'num_threads': 0, 'num_posts': 0,
+                    'last_published': '', 'mtime': 0}
+        return dict((k, row[k]) for k in
+                    ('num_threads', 'num_posts', 'last_published', 'mtime'))
+
+    def recount(self, current_subforum):
+        db = self.db()
+        with db:
+            self._recount(db, os.path.normpath(current_subforum))
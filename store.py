@@ -0,0 +1,411 @@
+"""
+store.py
+
+Where threads and their posts live. forum.py, threadindex.py and
+postrender.py go through a ThreadStore instead of reading thread
+files themselves; THREAD_STORAGE in config.py picks the backend:
+
+    'rss'    - RssStore, static/<subforum>/<thread>.rss rewritten per post
+    'log'    - LogStore, append-only post logs (postlog.py)
+    'sqlite' - SqliteStore, one indexed database (sqlitestore.py)
+    'segments' - SegmentStore, threads split into files of SEGMENT_SIZE
+               posts, all but the last immutable (segmentstore.py)
+
+Posts are numbered from 1, the OP, and come back as postlog.Post
+records whatever the backend.
+
+    python store.py migrate <from> <to> [static_dir]
+
+copies every thread from one backend to another, a thread at a time.
+
+    python store.py measure [static_dir]
+
+reports the memory the post records of every thread take.
+"""
+import os
+import sys
+
+import util
+import locks
+import rssparse
+import postlog
+import postrecord
+import postrender
+import threadcache
+
+# Posts per write when a backend can only take a thread in pieces
+MIGRATE_BATCH = 500
+
+
+class ThreadStore(object):
+    """
+    The operations the forum needs from thread storage. Subforums are
+    given the way the routes have them, '/' or '/sub'. Writes are made
+    by the caller holding the thread lock.
+    """
+
+    # Whether listings and counters come from the store itself rather
+    # than from threadindex's files
+    indexes_threads = False
+
+    def exists(self, thread_name, subforum='/'):
+        raise NotImplementedError
+
+    def info(self, thread_name, subforum='/'):
+        """ (title, link, num_posts) of a thread, None if there's no thread """
+        raise NotImplementedError
+
+    def mtime(self, thread_name, subforum='/'):
+        """ When the thread last had a post """
+        raise NotImplementedError
+
+    def posts(self, thread_name, subforum='/', start=0, stop=None):
+        """ Posts start to stop of a thread (0 is the OP), like a slice """
+        raise NotImplementedError
+
+    def create(self, thread_name, subforum, entry, link):
+        """ Start a thread with entry as its OP, feed link link """
+        raise NotImplementedError
+
+    def append(self, thread_name, subforum, entries):
+        """ Add posts to a thread, each with its number in entry['n'] """
+        raise NotImplementedError
+
+    def threads(self, subforum='/'):
+        """ Names of the threads in a subforum """
+        raise NotImplementedError
+
+    def rerender(self, thread_name, subforum='/'):
+        """ Redo out of date stored html, return how many posts changed """
+        raise NotImplementedError
+
+    def feed_is_stale(self, thread_name, subforum='/'):
+        """ Whether the public .rss feed is behind the thread """
+        return False
+
+    def export_rss(self, thread_name, subforum='/'):
+        """ Bring the public .rss feed up to date. Needs an app context. """
+        pass
+
+    def refresh_feeds(self, current_subforum='static'):
+        """ export_rss every thread of a subforum whose feed is stale """
+        subforum = _subforum(current_subforum)
+        for thread_name in self.threads(subforum):
+            if self.feed_is_stale(thread_name, subforum):
+                self.export_rss(thread_name, subforum)
+
+    def import_thread(self, thread_name, subforum, posts, mtime=None):
+        """
+        Store a whole thread, replacing any thread of that name, from
+        an iterable of posts oldest first, last posted to at mtime.
+        Used by migrate.
+        """
+        posts = iter(posts)
+        op = next(posts, None)
+        if op is None:
+            return
+        self.create(thread_name, subforum, op, op.get('feed_link', ''))
+        batch = []
+        for post in posts:
+            batch.append(post)
+            if len(batch) >= MIGRATE_BATCH:
+                self.append(thread_name, subforum, batch)
+                batch = []
+        if batch:
+            self.append(thread_name, subforum, batch)
+        if mtime:
+            self.touch(thread_name, subforum, mtime)
+
+    def touch(self, thread_name, subforum, mtime):
+        """ Set when the thread was last posted to """
+        raise NotImplementedError
+
+
+def _subforum(current_subforum):
+    """ 'static/sub' -> '/sub' """
+    return os.path.normpath(current_subforum)[len('static'):] or '/'
+
+
+def _rss_post(entry, n, rendered):
+    """ A copy of a feed entry, with its stored html if any """
+    # Shares the entry's text, a cached feed's entries stay as they are
+    post = postlog.Post(entry)
+    post['n'] = n
+    if n in rendered:
+        post['renderer'], post['html'] = rendered[n]
+    return post
+
+
+class RssStore(ThreadStore):
+    """
+    Threads as rss feeds, newest post first, rewritten on every reply.
+    Post html is kept in a .rendered file next to the feed.
+    """
+
+    def _parse(self, thread_name, subforum):
+        thread = threadcache.load(postlog.rss_path(thread_name, subforum),
+                                  rssparse.parse)
+        if not thread.feed or not thread.entries:
+            return None
+        return thread
+
+    def exists(self, thread_name, subforum='/'):
+        return os.path.exists(postlog.rss_path(thread_name, subforum))
+
+    def info(self, thread_name, subforum='/'):
+        thread = self._parse(thread_name, subforum)
+        if thread is None:
+            return None
+        return (thread.feed.get('title', ''), thread.feed.get('link', ''),
+                len(thread.entries))
+
+    def mtime(self, thread_name, subforum='/'):
+        return os.stat(postlog.rss_path(thread_name, subforum)).st_mtime
+
+    def posts(self, thread_name, subforum='/', start=0, stop=None):
+        path = postlog.rss_path(thread_name, subforum)
+        if os.path.exists(path) and \
+                os.path.getsize(path) > threadcache.cache.max_bytes:
+            # Too big to keep parsed, parse just the posts asked for
+            return self._read_posts(thread_name, subforum, start, stop)
+        return self._cached_posts(thread_name, subforum, start, stop)
+
+    def _read_posts(self, thread_name, subforum, start, stop):
+        feed_file = rssparse.FeedFile(postlog.rss_path(thread_name, subforum))
+        if not feed_file.feed or not len(feed_file):
+            return
+        rendered = postrender.load_rendered(thread_name, subforum)
+        for n, entry in feed_file.posts(start, stop):
+            post = _rss_post(entry, n, rendered)
+            if n == 1:
+                post['feed_link'] = feed_file.feed.get('link', '')
+            yield post
+
+    def _cached_posts(self, thread_name, subforum, start, stop):
+        thread = self._parse(thread_name, subforum)
+        if thread is None:
+            return
+        rendered = postrender.load_rendered(thread_name, subforum)
+        total = len(thread.entries)
+        start, stop, _ = slice(start, stop).indices(total)
+        for i in range(start, stop):
+            # Entries are newest first, post i is counted from the back
+            post = _rss_post(thread.entries[total - 1 - i], i + 1, rendered)
+            if i == 0:
+                post['feed_link'] = thread.feed.get('link', '')
+            yield post
+
+    def create(self, thread_name, subforum, entry, link):
+        util.render_thread_rss(thread_name, subforum,
+                               [entry], entry['title'], link=link)
+        postrender.append_rendered(thread_name, subforum, 1, entry)
+
+    def append(self, thread_name, subforum, entries):
+        # Read the file itself, not a cached parse that may be behind
+        thread = rssparse.parse(postlog.rss_path(thread_name, subforum))
+        util.render_thread_rss(thread_name, subforum,
+                               list(reversed(entries)) + thread.entries,
+                               title=thread.feed['title'],
+                               link=thread.feed['link'])
+        for entry in entries:
+            if 'html' in entry:
+                postrender.append_rendered(thread_name, subforum,
+                                           entry['n'], entry)
+
+    def threads(self, subforum='/'):
+        return [name[:-4] for name in util.sorted_ls('static' + subforum)
+                if name[-4:] == '.rss']
+
+    def rerender(self, thread_name, subforum='/'):
+        return postrender.rerender_rss(thread_name, subforum)
+
+    def refresh_feeds(self, current_subforum='static'):
+        # The feeds are the threads
+        pass
+
+    def touch(self, thread_name, subforum, mtime):
+        os.utime(postlog.rss_path(thread_name, subforum), (mtime, mtime))
+
+    def import_thread(self, thread_name, subforum, posts, mtime=None):
+        # A feed can only be written whole
+        posts = list(posts)
+        if not posts:
+            return
+        util.render_thread_rss(thread_name, subforum, list(reversed(posts)),
+                               title=posts[0]['title'],
+                               link=posts[0].get('feed_link', ''))
+        path = postrender.rendered_path(thread_name, subforum)
+        if os.path.exists(path):
+            os.unlink(path)
+        for post in posts:
+            if 'html' in post:
+                postrender.append_rendered(thread_name, subforum,
+                                           post['n'], post)
+        if mtime:
+            self.touch(thread_name, subforum, mtime)
+
+
+class LogStore(RssStore):
+    """
+    Threads as append-only post logs, with the .rss feed exported from
+    the log. Threads still only in rss are read from the feed and get a
+    log on their first reply.
+    """
+
+    def exists(self, thread_name, subforum='/'):
+        return (postlog.exists(thread_name, subforum) or
+                RssStore.exists(self, thread_name, subforum))
+
+    def info(self, thread_name, subforum='/'):
+        if not postlog.exists(thread_name, subforum):
+            return RssStore.info(self, thread_name, subforum)
+        return postlog.thread_info(thread_name, subforum)
+
+    def mtime(self, thread_name, subforum='/'):
+        if not postlog.exists(thread_name, subforum):
+            return RssStore.mtime(self, thread_name, subforum)
+        return os.stat(postlog.log_path(thread_name, subforum)).st_mtime
+
+    def posts(self, thread_name, subforum='/', start=0, stop=None):
+        if not postlog.exists(thread_name, subforum):
+            return RssStore.posts(self, thread_name, subforum, start, stop)
+        # Seek straight to the posts through the offset index
+        return postlog.PostIndex(thread_name, subforum).iter(start, stop)
+
+    def create(self, thread_name, subforum, entry, link):
+        # Readers of the feed shouldn't have to wait for an export
+        util.render_thread_rss(thread_name, subforum,
+                               [entry], entry['title'], link=link)
+        postlog.append_post(thread_name, subforum,
+                            dict(entry, n=1, feed_link=link))
+
+    def append(self, thread_name, subforum, entries):
+        if not postlog.exists(thread_name, subforum):
+            # Thread predates the post log, convert it once
+            postlog.import_rss(thread_name, subforum)
+        postlog.append_posts(thread_name, subforum, entries)
+
+    def rerender(self, thread_name, subforum='/'):
+        if not postlog.exists(thread_name, subforum):
+            return RssStore.rerender(self, thread_name, subforum)
+        return postrender.rerender_log(thread_name, subforum)
+
+    def feed_is_stale(self, thread_name, subforum='/'):
+        return (postlog.exists(thread_name, subforum) and
+                postlog.is_stale(thread_name, subforum))
+
+    def export_rss(self, thread_name, subforum='/'):
+        postlog.export_rss(thread_name, subforum)
+
+    def refresh_feeds(self, current_subforum='static'):
+        postlog.refresh_feeds(current_subforum)
+
+    def touch(self, thread_name, subforum, mtime):
+        if not postlog.exists(thread_name, subforum):
+            return RssStore.touch(self, thread_name, subforum, mtime)
+        os.utime(postlog.log_path(thread_name, subforum), (mtime, mtime))
+
+    def import_thread(self, thread_name, subforum, posts, mtime=None):
+        postlog.write_log(thread_name, subforum, posts)
+        if mtime:
+            self.touch(thread_name, subforum, mtime)
+
+
+_stores = {}
+
+
+def get_store(kind=None):
+    """ The backend named kind, by default the one THREAD_STORAGE names """
+    from main import app
+
+    if kind is None:
+        kind = app.config.get('THREAD_STORAGE', 'rss')
+
+    store = _stores.get(kind)
+    if store is None:
+        if kind == 'rss':
+            store = RssStore()
+        elif kind == 'log':
+            store = LogStore()
+        elif kind == 'sqlite':
+            import sqlitestore
+            store = sqlitestore.SqliteStore(
+                app.config.get('SQLITE_PATH', 'forum.db'))
+        elif kind == 'segments':
+            import segmentstore
+            store = segmentstore.SegmentStore()
+        else:
+            raise ValueError('Unknown THREAD_STORAGE ' + repr(kind))
+        _stores[kind] = store
+    return store
+
+
+def migrate(source, dest, current_subforum='static'):
+    """
+    Copy every thread of a subforum and everything below it from the
+    source backend to the dest one. Posts are streamed from one to the
+    other as far as the backends allow.
+    """
+    if not isinstance(source, ThreadStore):
+        source = get_store(source)
+    if not isinstance(dest, ThreadStore):
+        dest = get_store(dest)
+    subforum = _subforum(current_subforum)
+
+    for thread_name in source.threads(subforum):
+        with locks.lock(thread_name + '.lock') as lock, lock.fenced():
+            # Keep the thread's place in the listings
+            dest.import_thread(thread_name, subforum,
+                               source.posts(thread_name, subforum),
+                               source.mtime(thread_name, subforum))
+        print 'Migrated ' + os.path.join(current_subforum, thread_name)
+
+    for name in util.find_subforums(current_subforum):
+        migrate(source, dest, os.path.join(current_subforum, name))
+
+
+def measure(current_subforum='static'):
+    """
+    (posts, record bytes, dict bytes) of every thread of a subforum
+    and below: what their Post records take on top of the posts' text,
+    and what the same posts took as dicts
+    """
+    threads = get_store()
+    subforum = _subforum(current_subforum)
+    posts = records = dicts = 0
+    for thread_name in threads.threads(subforum):
+        for post in threads.posts(thread_name, subforum):
+            posts += 1
+            records += postrecord.overhead(post)
+            dicts += sys.getsizeof(post.as_dict())
+
+    for name in util.find_subforums(current_subforum):
+        more = measure(os.path.join(current_subforum, name))
+        posts, records, dicts = (posts + more[0], records + more[1],
+                                 dicts + more[2])
+    return posts, records, dicts
+
+
+if __name__ == '__main__':
+    # python store.py migrate <from> <to> [static_dir]
+    # python store.py measure [static_dir]
+    if sys.argv[1:2] == ['measure']:
+        from main import app
+
+        posts, records, dicts = measure(
+            sys.argv[2] if len(sys.argv) > 2 else 'static')
+        print '{} posts, {} bytes per post record, {} as dicts'.format(
+            posts, records // max(posts, 1), dicts // max(posts, 1))
+        sys.exit(0)
+
+    if len(sys.argv) < 4 or sys.argv[1] != 'migrate':
+        print 'usage: python store.py migrate <from> <to> [static_dir]'
+        sys.exit(1)
+
+    from main import app
+
+    with app.app_context():
+        migrate(sys.argv[2], sys.argv[3],
+                sys.argv[4] if len(sys.argv) > 4 else 'static')
+    print 'Set THREAD_STORAGE = {!r} and run python threadindex.py'.format(
+        sys.argv[3])
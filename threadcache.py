@@ -0,0 +1,97 @@
+"""
+threadcache.py
+
+In-process cache of parsed threads. Entries are keyed by path and
+checked against the file's identity (inode, size and mtime) on every
+lookup, so a write to the file is picked up by the next read without
+any explicit invalidation.
+"""
+import os
+import threading
+import feedparser
+
+from collections import OrderedDict
+
+import config
+
+
+class ThreadCache(object):
+    """
+    LRU cache of parsed thread files, bounded by number of entries and
+    by the total size of the cached files on disk
+    """
+
+    def __init__(self, max_entries=256, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, path, loader=feedparser.parse):
+        """
+        Return loader(path), reusing the last result for this path if
+        the file hasn't changed since. Missing files aren't cached.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return loader(path)
+        ident = (st.st_ino, st.st_size, st.st_mtime)
+
+        with self._lock:
+            cached = self._entries.pop(path, None)
+            if cached is not None:
+                self.size -= cached[1]
+                if cached[0] == ident:
+                    self.hits += 1
+                    self._entries[path] = cached
+                    self.size += cached[1]
+                    return cached[2]
+            self.misses += 1
+
+        value = loader(path)
+
+        if st.st_size <= self.max_bytes:
+            with self._lock:
+                old = self._entries.pop(path, None)
+                if old is not None:
+                    self.size -= old[1]
+                self._entries[path] = (ident, st.st_size, value)
+                self.size += st.st_size
+                self._evict()
+        return value
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or
+                                 self.size > self.max_bytes):
+            path, cached = self._entries.popitem(last=False)
+            self.size -= cached[1]
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """ Counters for monitoring the cache """
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'bytes': self.size,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+cache = ThreadCache(max_entries=getattr(config, 'THREAD_CACHE_ENTRIES', 256),
+                    max_bytes=getattr(config, 'THREAD_CACHE_BYTES',
+                                      64 * 1024 * 1024))
+
+
+def load(path, loader=feedparser.parse):
+    """ Load a thread file through the shared cache """
+    return cache.load(path, loader)
@@ -0,0 +1,401 @@
+"""
+threadindex.py
+
+Per-subforum index of thread metadata, so listing a subforum doesn't
+parse every thread in it. Lives in static/<subforum>/.threads.json
+and is updated by new_thread and reply_thread.
+
+A post doesn't rewrite .threads.json: it appends a line with what
+changed, the thread's new activity time included, to the bump file
+.threads.<generation>.bumps named in it. Each process keeps the index
+it read and applies the bumps appended since, moving every bumped
+thread in its sorted order, so listing page 1 after a reply costs the
+lines of that reply and not a sort of the subforum. Every
+COMPACT_BUMPS bumps they're folded into a new .threads.json of a new
+generation.
+
+Thread and post totals of each subforum are kept separately in
+static/<subforum>/.counters.json, so the subforum panel only reads
+one small file per subforum.
+
+Stores that index threads themselves (the 'sqlite' THREAD_STORAGE)
+answer all of this from their own tables, and the files aren't kept.
+"""
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import errno
+import bisect
+import threading
+
+import util
+import locks
+import store
+import threadcache
+
+INDEX_NAME = '.threads.json'
+BUMPS_NAME = '.threads.{}.bumps'
+BUMPS_FILE = re.compile(r'^\.threads\.[0-9a-f]+\.bumps$')
+COUNTERS_NAME = '.counters.json'
+
+# Bumps a bump file takes before it's folded into .threads.json
+COMPACT_BUMPS = 1000
+
+
+def index_path(current_subforum='static'):
+    return os.path.join(os.path.normpath(current_subforum), INDEX_NAME)
+
+
+def bumps_path(current_subforum, generation):
+    return os.path.join(os.path.normpath(current_subforum),
+                        BUMPS_NAME.format(generation))
+
+
+def _read_index(path):
+    with open(path, 'rb') as f:
+        return json.load(f)
+
+
+def _read_snapshot(path):
+    """ (generation, {thread_name: metadata}) of a .threads.json """
+    data = _read_index(path)
+    if (isinstance(data.get('generation'), basestring) and
+            isinstance(data.get('threads'), dict)):
+        return data['generation'], data['threads']
+    # Written before there were bump files
+    return None, data
+
+
+def _write_snapshot(path, threads):
+    """ Write out .threads.json as a new generation, return it """
+    generation = uuid.uuid4().hex
+    util.atomic_write(path, json.dumps({'generation': generation,
+                                        'threads': threads}))
+    return generation
+
+
+def _merge(meta, fields):
+    merged = dict(meta or {'name': fields['name']})
+    merged.update(fields)
+    return merged
+
+
+class ThreadIndex(dict):
+    """
+    {thread_name: metadata} of a subforum, plus the thread names in
+    order of latest activity, as of a .threads.json and the bumps
+    applied to it since (offset bytes of its bump file). Shared by the
+    threads of a process: hold lock to read more than one thread.
+    """
+
+    def __init__(self, threads, generation=None, ident=None):
+        dict.__init__(self, threads)
+        self.order = sorted(activity_key(t) for t in self.values())
+        self.generation = generation
+        self.ident = ident
+        self.offset = 0
+        self.bumps = 0
+        self.lock = threading.RLock()
+
+    def bump(self, fields):
+        """ Merge fields into a thread's metadata and move it in order """
+        with self.lock:
+            old = self.get(fields['name'])
+            meta = _merge(old, fields)
+            if old is not None:
+                key = activity_key(old)
+                i = bisect.bisect_left(self.order, key)
+                if i < len(self.order) and self.order[i] == key:
+                    del self.order[i]
+            bisect.insort(self.order, activity_key(meta))
+            self[meta['name']] = meta
+
+    def catch_up(self, current_subforum):
+        """ Apply the bumps appended to the bump file since last time """
+        if self.generation is None:
+            return
+        with self.lock:
+            try:
+                with open(bumps_path(current_subforum, self.generation),
+                          'rb') as f:
+                    f.seek(self.offset)
+                    data = f.read()
+            except IOError as e:
+                # None yet, or folded into a newer .threads.json, which
+                # the next load reads
+                if e.errno != errno.ENOENT:
+                    raise
+                return
+            # Leave a line being appended for next time
+            end = data.rfind('\n') + 1
+            for line in data[:end].splitlines():
+                try:
+                    fields = json.loads(line)
+                except ValueError:
+                    # Torn by a crash mid-append
+                    continue
+                self.bump(fields)
+                self.bumps += 1
+            self.offset += end
+
+    def page(self, after=None, limit=None):
+        """
+        Threads following the cursor after, up to limit of them, and
+        the cursor of the page after that (None on the last page)
+        """
+        with self.lock:
+            start = 0
+            if after is not None:
+                start = bisect.bisect_right(self.order, after)
+            stop = len(self.order) if limit is None else start + limit
+
+            threads = [self[name] for _, name in self.order[start:stop]]
+            cursor = None
+            if stop < len(self.order):
+                cursor = self.order[stop - 1]
+        return threads, cursor
+
+
+def activity_key(meta):
+    """ Sort key putting the latest activity first """
+    return (-meta['mtime'], meta['name'])
+
+
+def format_cursor(key):
+    return '{!r}:{}'.format(-key[0], key[1])
+
+
+def parse_cursor(cursor):
+    """ Turn a cursor from a url back into a key, None if it's garbage """
+    try:
+        mtime, name = cursor.split(':', 1)
+        return (-float(mtime), name)
+    except (ValueError, AttributeError):
+        return None
+
+
+_live = {}
+_live_lock = threading.Lock()
+
+
+def _ident(path):
+    st = os.stat(path)
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+
+def load(current_subforum='static'):
+    """
+    Return the index of a subforum as a ThreadIndex, building it
+    first if it doesn't exist yet
+    """
+    path = index_path(current_subforum)
+    if not os.path.exists(path):
+        rebuild(current_subforum)
+
+    ident = _ident(path)
+    with _live_lock:
+        index = _live.get(path)
+    if index is None or index.ident != ident:
+        # A new generation, start over from it
+        generation, threads = _read_snapshot(path)
+        index = ThreadIndex(threads, generation, ident)
+        with _live_lock:
+            _live[path] = index
+    index.catch_up(current_subforum)
+    return index
+
+
+def thread(current_subforum, thread_name):
+    """ Metadata of one thread, None if the subforum has no such thread """
+    threads = store.get_store()
+    if threads.indexes_threads:
+        return threads.thread_meta(current_subforum, thread_name)
+    return load(current_subforum).get(thread_name)
+
+
+def threads(current_subforum='static'):
+    """ Metadata of every thread in a subforum, latest activity first """
+    return page(current_subforum)[0]
+
+
+def page(current_subforum='static', after=None, limit=None):
+    """
+    One page of a subforum's threads, latest activity first, starting
+    after the thread the url cursor after points at. Returns the
+    threads and the cursor of the next page, or None.
+    """
+    key = parse_cursor(after) if after else None
+    threads = store.get_store()
+    if threads.indexes_threads:
+        threads, cursor = threads.page(current_subforum, key, limit)
+    else:
+        threads, cursor = load(current_subforum).page(key, limit)
+    return threads, cursor and format_cursor(cursor)
+
+
+def _append(path, line):
+    with open(path, 'a+b') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell():
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != '\n':
+                # Drop what's left of a bump we crashed while writing
+                f.seek(0)
+                f.truncate(f.read().rfind('\n') + 1)
+        f.write(line)
+
+
+def update(current_subforum, thread_name, **fields):
+    """
+    Merge fields into a thread's metadata and bump its activity time.
+    Pass num_posts=None to leave the post count alone.
+    """
+    if store.get_store().indexes_threads:
+        # Kept by the store as it writes
+        return
+    path = index_path(current_subforum)
+    with locks.lock(path):
+        if not os.path.exists(path):
+            _write_snapshot(path, scan(current_subforum))
+        index = load(current_subforum)
+
+        bump = dict((k, v) for k, v in fields.items() if v is not None)
+        bump['name'] = thread_name
+        bump['mtime'] = time.time()
+
+        if index.generation is not None and index.bumps < COMPACT_BUMPS:
+            _append(bumps_path(current_subforum, index.generation),
+                    json.dumps(bump) + '\n')
+            return
+
+        # Fold the bumps into a new generation of .threads.json
+        with index.lock:
+            threads = dict(index)
+        threads[thread_name] = _merge(threads.get(thread_name), bump)
+        _write_snapshot(path, threads)
+        if index.generation is not None:
+            os.unlink(bumps_path(current_subforum, index.generation))
+
+
+def thread_metadata(current_subforum, thread_name):
+    """ Read the metadata of one thread from the store """
+    subforum = os.path.normpath(current_subforum)[len('static'):] or '/'
+    threads = store.get_store()
+
+    info = threads.info(thread_name, subforum)
+    if not info:
+        return None
+    title, link, num_posts = info
+    op = next(threads.posts(thread_name, subforum, 0, 1))
+    last = next(threads.posts(thread_name, subforum, num_posts - 1, None))
+
+    return {'name': thread_name,
+            'title': title,
+            'link': link,
+            'num_posts': num_posts,
+            'mtime': threads.mtime(thread_name, subforum),
+            'op_author': op.get('author', ''),
+            'last_author': last.get('author', ''),
+            'last_published': last.get('published', '')}
+
+
+def counters_path(current_subforum='static'):
+    return os.path.join(os.path.normpath(current_subforum), COUNTERS_NAME)
+
+
+def _count(index):
+    """ Totals of a subforum from its thread index """
+    latest = max(index.values(), key=lambda t: t['mtime']) if index else {}
+    return {'num_threads': len(index),
+            'num_posts': sum(t.get('num_posts', 0) for t in index.values()),
+            'last_published': latest.get('last_published', ''),
+            'mtime': latest.get('mtime', 0)}
+
+
+def counters(current_subforum='static'):
+    """
+    Return the thread and post totals and last activity of a subforum,
+    counting them from the thread index the first time
+    """
+    threads = store.get_store()
+    if threads.indexes_threads:
+        return threads.counters(current_subforum)
+    path = counters_path(current_subforum)
+    if not os.path.exists(path):
+        index = load(current_subforum)
+        with locks.lock(path):
+            if not os.path.exists(path):
+                with index.lock:
+                    totals = _count(index)
+                util.atomic_write(path, json.dumps(totals))
+    return threadcache.load(path, _read_index)
+
+
+def bump_counters(current_subforum, threads=0, posts=0, published=''):
+    """ Add new threads and posts to a subforum's totals """
+    if store.get_store().indexes_threads:
+        return
+    path = counters_path(current_subforum)
+    with locks.lock(path):
+        if os.path.exists(path):
+            totals = _read_index(path)
+            totals['num_threads'] += threads
+            totals['num_posts'] += posts
+        else:
+            # The thread index already has these posts in it
+            index = load(current_subforum)
+            with index.lock:
+                totals = _count(index)
+        totals['last_published'] = published
+        totals['mtime'] = time.time()
+
+        util.atomic_write(path, json.dumps(totals))
+
+
+def scan(current_subforum='static'):
+    """ Build the index of a subforum from its threads """
+    index = {}
+    subforum = os.path.normpath(current_subforum)[len('static'):] or '/'
+    for name in store.get_store().threads(subforum):
+        meta = thread_metadata(current_subforum, name)
+        if meta:
+            index[meta['name']] = meta
+    return index
+
+
+def rebuild(current_subforum='static'):
+    """ Rewrite the index of a subforum from scratch """
+    threads = store.get_store()
+    if threads.indexes_threads:
+        threads.recount(current_subforum)
+        return
+
+    path = index_path(current_subforum)
+    with locks.lock(path):
+        index = scan(current_subforum)
+        generation = _write_snapshot(path, index)
+        # Bumps of older generations are in the threads scanned
+        for name in os.listdir(os.path.dirname(path)):
+            if (BUMPS_FILE.match(name) and
+                    name != BUMPS_NAME.format(generation)):
+                os.unlink(os.path.join(os.path.dirname(path), name))
+
+    path = counters_path(current_subforum)
+    with locks.lock(path):
+        util.atomic_write(path, json.dumps(_count(index)))
+
+
+def rebuild_all(current_subforum='static'):
+    """ rebuild for a subforum and everything below it """
+    rebuild(current_subforum)
+    for name in util.find_subforums(current_subforum):
+        rebuild_all(os.path.join(current_subforum, name))
+
+
+if __name__ == '__main__':
+    # python threadindex.py [static_dir]
+    # Rebuild the thread indexes from the thread store
+    rebuild_all(sys.argv[1] if len(sys.argv) > 1 else 'static')
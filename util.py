@@ -4,10 +4,18 @@ util.py
 System and convenience functions
 """
 import re, os
+import time
+import hashlib
 import feedparser
 import codecs
+import tempfile
 
-from flask import render_template, flash
+import dircache
+
+from flask import render_template, flash, get_flashed_messages, Response, \
+    make_response, request, session, g
+from flask.globals import _request_ctx_stack
+from flask_wtf.csrf import generate_csrf
 
 # Regex matching substrings of alphanumeric plus spaces, dashes, and underscores
 FILTER_ALPHANUMERIC = '[a-zA-Z0-9 \-\_]+'
@@ -73,24 +81,16 @@ def filter(pattern, text):
     return ''.join(re.findall(pattern, text)) 
 
 
-def find_threads(current_subforum='static'):
-    """
-     Return all files in the current directory
-     ending in .rss. Threads are just rss feeds
-    """
-    threads = [feedparser.parse(os.path.join(current_subforum, x)) for x in reversed(sorted_ls(current_subforum)) if x[-4:] == '.rss']
-
-    return threads
-
-
 def find_subforums(current_subforum='static'):
     """ Return all non-special subdirectories, they are subforums """
-    return [x for x in os.listdir(current_subforum) if os.path.isdir(os.path.join(current_subforum,x)) and not x in ('img','users', 'themes', 'lib', 'cgi-bin', 'templates', 'static') and x[0] != '.']
+    return [x for x in dircache.listing(current_subforum).subdirs() if not x in ('img','users', 'themes', 'lib', 'cgi-bin', 'templates', 'static') and x[0] != '.' and not x.endswith('.segments')]
 
 def subforums(current_subforum='static'):
     """
     Return a collection of subforum objects and metainfo
     """
+    import threadindex
+
     subforum_names = find_subforums(current_subforum=current_subforum)
     subforums = []
     for dir_name in subforum_names:
@@ -98,15 +98,45 @@ def subforums(current_subforum='static'):
         subforum_info = {'name': dir_name}
 
         subforum_dir = os.path.join(current_subforum, dir_name)
-        threads = find_threads(current_subforum=subforum_dir)
-
-        subforum_info['num_threads'] = len(threads)
+        subforum_info.update(threadindex.counters(subforum_dir))
 
         subforums.append(subforum_info)
 
     return subforums
 
 
+def sanitize_html(text):
+    """ Sanitize post html the same way feedparser does for rss entries """
+    html = feedparser._sanitizeHTML(text, 'utf-8', u'text/html')
+    # Comes back utf-8 encoded, Markdown and the templates want unicode
+    if isinstance(html, str):
+        html = html.decode('utf-8')
+    return html
+
+
+def atomic_write(path, text, encoding=None):
+    """
+    Write a file by writing a temporary file next to it and
+    renaming it into place, so readers never see half a file
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                               prefix='.' + os.path.basename(path))
+    try:
+        f = os.fdopen(fd, 'wb')
+        if encoding:
+            f = codecs.getwriter(encoding)(f)
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        # mkstemp files are private, feeds are served to everyone
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+
 def filenameify(name):
     """
     Turns a human-provided filename into a nice-looking
@@ -116,9 +146,81 @@ def filenameify(name):
 
 
 def sorted_ls(path):
-    """ Returns a directory listing sorted. Thanks HarryM from StackOverflow """
-    mtime = lambda f: os.stat(os.path.join(path, f)).st_mtime
-    return list(sorted(os.listdir(path), key=mtime))
+    """ Returns a directory listing sorted by mtime, from the listing cache """
+    return dircache.listing(path).by_mtime()
+
+
+def stream_template(template_name, **context):
+    """
+    Like render_template, but returns a response that sends the page
+    as the template renders it instead of building it all first
+    """
+    from main import app
+
+    # The session is saved before the body is sent, so anything the
+    # template takes from or puts in it has to happen now
+    get_flashed_messages()
+    generate_csrf()
+
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(app.config.get('STREAM_BUFFER_SIZE', 8))
+    return Response(_with_request_context(stream))
+
+
+def _with_request_context(stream):
+    """
+    Keep the request context around while the body is sent. This is
+    flask.stream_with_context, except that pushing the context again
+    reopens the session in this Flask version, which would throw away
+    what this request put in it, so the request's session is put back.
+    """
+    ctx = _request_ctx_stack.top
+    session = ctx.session
+
+    def generate():
+        with ctx:
+            ctx.session = session
+            yield None
+            for chunk in stream:
+                yield chunk
+
+    body = generate()
+    # Push the context now, while it's still alive
+    next(body)
+    return body
+
+
+def page_etag(version, nonce):
+    """
+    ETag of an html page: the version of its content plus the session
+    state rendered around it (login nonce, user, CSRF token). CSRF
+    tokens expire, so tags also roll over every half hour.
+    """
+    parts = (version, str(nonce), session.get('username'),
+             session.get('csrf_token'), int(time.time() // 1800))
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+
+def conditional_page(version, render):
+    """
+    Answer 304 Not Modified if the client's copy of this page has the
+    content at version, otherwise return render() tagged with an ETag
+    """
+    previous = g.get('previous_nonce')
+    if previous and '_flashes' not in session and \
+            page_etag(version, previous) in request.if_none_match:
+        # The client keeps its copy, so the nonce it shows stays valid
+        session['nonce'] = previous
+        response = Response(status=304)
+        response.set_etag(page_etag(version, previous))
+    else:
+        response = make_response(render())
+        response.set_etag(page_etag(version, session.get('nonce')))
+
+    # Pages carry session state, and should be checked every time
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 
 def render_thread_rss(thread_name, subforum, posts, title='', link=''):
@@ -134,12 +236,10 @@ def render_thread_rss(thread_name, subforum, posts, title='', link=''):
     # if something goes wrong, but who knows?
     # TODO: Read the source, Luke.
     if text.__class__.__name__ == 'unicode' and text:
-        # DANGER TIME. Don't ctrl-c between these operations for now
-        # or else stuff gets deleted <:-0
-        # XXX: Fix dat.
-        f = codecs.open(os.path.normpath('static' + subforum + '/' + thread_name+'.rss'), 'w', 'utf-8')
-        f.write(text)
-        f.close()
+        # Replace the file by rename, so a crash can't leave half a
+        # thread behind and the directory mtime tells dircache
+        # something changed
+        atomic_write(os.path.normpath('static' + subforum + '/' + thread_name+'.rss'), text, encoding='utf-8')
 
     else:
         print 'Thread writing failed:: render_thread_rss'